@@ -18,6 +18,7 @@ import scope
 sliders = [0]*31
 slider_value_labels = [0]*31
 DriveStatus = -1
+SliderSetpoints = dmm.SetpointQueue(50) # Dragging a slider sends faster than the drive takes it.
 #----------------------------------------------------------------------------
 # Instantiate the user interface window
 #----------------------------------------------------------------------------
@@ -91,7 +92,7 @@ def CreateWindow():
                 current_values[s_num] = value
                 slider_value_labels[s_num].config(text=str(value))
                 print("send new value")
-                dmm.SendCommand(s_num, value) # Send to servo controller
+                SliderSetpoints.Send(s_num, value) # Send to servo controller
 
         slider.bind("<Motion>", on_slider_change)
         slider.bind("<ButtonRelease-1>", on_slider_change)
@@ -206,10 +207,11 @@ def ShowDriveStatus(status=-1):
 def SendAllParameters():
     print("Sending servo parameters")
     print(current_values)
-    for s in range(0,len(sliders_info)):
-        id = sliders_info[s][0]
-        if id > 0:
-            dmm.SendCommand(sliders_info[s][0], current_values[id])
+    with dmm.Batch():
+        for s in range(0,len(sliders_info)):
+            id = sliders_info[s][0]
+            if id > 0:
+                dmm.SendCommand(sliders_info[s][0], current_values[id])
     dmm.RecvData()
 
 #----------------------------------------------------------------------------
@@ -218,22 +220,15 @@ def SendAllParameters():
 def ReadAllParameters():
     print("Read all parameters")
     # Request all parameters.
-    dmm.RecvData() # Clear out received stuff so far.
+    dmm.RecvData(0) # Clear out received stuff so far.
 
     ParmsGet = ["Drive_Status","MainGain","SpeedGain","IntGain","TrqCons","HighSpeed","HighAccel","GearNumber"]
-    for p in ParmsGet: dmm.SendCommand("Read_"+p) # request parameters
+    Pending = [dmm.SendCommand("Read_"+p) for p in ParmsGet] # request parameters
 
-    dmm.ReplyValues = [1000000000]*32 # Erase previous decoded replies
-    time.sleep(0.15) # Need to wati a bit for all the replies to be ready.
-    dmm.RecvData() # decode all the replies from serial.
-
-    ReplyIds = [0x10,0x11,0x12, # MainGain, SpeedGain, IntGain
-                0x13,0x14,0x15, # TrqConst, HighSpeed, HighAccel
-                0x18, 0x19] # Gear ratio, Drive Status
-
-    for s in ReplyIds:
-        recvd = dmm.ReplyValues[s]
-        if recvd == 1000000000:
+    for Reply in Pending:
+        s = Reply.ReplyId
+        recvd = Reply.Result(0.15)
+        if recvd is None:
             print("Did not get %02x"%(s))
             continue
         elif s == 0x18: # Gear ratio
@@ -257,6 +252,7 @@ def InitServo():
         tk.messagebox.showwarning(title="Servo tuner", message="No DMM controller found", parent=root)
         return
     root.title("DMM servo tuner.  Connected %s, ID=%d"%(ret))
+    dmm.StartTxScheduler() # Stop/reset buttons go ahead of the scope's queries.
 
     #SendAllParameters()
 
@@ -265,48 +261,48 @@ def InitServo():
 #----------------------------------------------------------------------------
 # Functions for button push actions
 #----------------------------------------------------------------------------
+def ReadDriveStatus():
+    Status = dmm.ReqDriveStatus().Result()
+    ShowDriveStatus(-1 if Status is None else Status)
+
 def ButtonDriveReset():
     dmm.DriveReset()
     TestMotionActive = 0
-    dmm.ReplyValues = [1000000000]*32 # Erase previous decoded replies
     time.sleep(0.2)
-    dmm.ReqDriveStatus()
     SendAllParameters() # Put our parameters back on the servo
-    dmm.RecvData(0.1)
-    ShowDriveStatus()
+    ReadDriveStatus()
 
 def PeriodicMotion():
     # this called periodically after motion start button is pushed.
     global TestMotionActive
     if not TestMotionActive: return
+    MotionSchedule.Mark()
     #print("Move to:",TestMotionActive & 0xfffe)
     dmm.SendCommand("Go_Absolute_Pos", TestMotionActive & 0xfffe)
     dmm.RecvData()
     TestMotionActive ^= 4096
-    root.after(1200,PeriodicMotion)
+    root.after(MotionSchedule.Delay(),PeriodicMotion)
     dmm.RecvData()
     ShowDriveStatus()
 
 def ButtonStartMotion():
-    global TestMotionActive
+    global TestMotionActive, MotionSchedule
     print("Start test motion")
 
-    dmm.ReqDriveStatus() # Update drive status (in case that prevents test motion)
-    dmm.RecvData(0.1)
-    ShowDriveStatus()
+    ReadDriveStatus() # Update drive status (in case that prevents test motion)
 
     if TestMotionActive: return # Don't start more than one!
     #dmm.SendCommand("Set_Origin")
     dmm.DriveEnable()
     TestMotionActive = 1
+    MotionSchedule = dmm.PeriodicSchedule(1.2) # Move every 1.2 seconds
     PeriodicMotion()
 
 def ButtonStopMotion():
     global TestMotionActive
+    if TestMotionActive: print("Test motion:", MotionSchedule.Summary())
     TestMotionActive = 0
-    dmm.ReqDriveStatus()
-    dmm.RecvData(0.1)
-    ShowDriveStatus()
+    ReadDriveStatus()
 
 # Start the Tkinter main window and event loop
 dmm.ShowSerialBytes = True
@@ -316,4 +312,5 @@ CreateWindow()
 root.mainloop()
 
 # On mainloop exit, window is closed.  Disable drive to be safe.
+SliderSetpoints.Close()
 dmm.DriveDisable()
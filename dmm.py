@@ -14,6 +14,8 @@ def Control_C_Abort(signal, frame):
     print("Abort -- disable drive\n");
     dmm.DriveDisable()
     dmm.RecvData()
+    dmm.PrintStats()
+    dmm.StopCapture()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, Control_C_Abort)
@@ -25,8 +27,7 @@ def ReadAllParameters():
         name = dmm.SendCommandLookup[key]
         if name.startswith("Read_"):
             #print (name)
-            dmm.SendCommand(key)
-            dmm.RecvData()
+            dmm.SendCommand(key).Result()
 
     print("Values:",dmm.ReplyValues)
 
@@ -34,9 +35,10 @@ def ReadAllParameters():
 # Read all the parameters from the controller
 #===========================================================================================
 def ShowDriveStatus():
-    dmm.SendCommand("Read_Drive_Status")
-    dmm.RecvData()
-    DriveStatus = dmm.ReplyValues[0x19]
+    DriveStatus = dmm.ReqDriveStatus().Result()
+    if DriveStatus is None:
+        print("No reply to Read_Drive_Status")
+        return
     if DriveStatus == 14: DriveStatus = "Over Heat"
     if DriveStatus == 46: DriveStatus = "Over Heat"
     if DriveStatus == 6:  DriveStatus = "Lost Phase"
@@ -50,34 +52,35 @@ def ShowDriveStatus():
 def TorquePlot(duration): # Plot torque reading while raising and lowering weight
     endtime = time.time()+duration
     dmm.ShowReplies = False
-    while True:
-        dmm.ReqTorqCurrent()
-        if time.time() > endtime: break
-        dmm.RecvData()
-        Torque = dmm.ReplyValues[0x1e]
-        numchars = int(abs(Torque) / 10)
-        if numchars > 100: numchars = 100
-        Str = ("+" if Torque > 0 else "-")*numchars
-        print("%6d"%(Torque),Str+"##")
+    Sampler = dmm.Sampler({0x1e:1}, Rate=40)
+    Sampler.Start()
+    while time.time() < endtime:
+        for t, Torque in Sampler.Take(0x1e, timeout=0.1):
+            numchars = int(abs(Torque) / 10)
+            if numchars > 100: numchars = 100
+            Str = ("+" if Torque > 0 else "-")*numchars
+            print("%6d"%(Torque),Str+"##")
+    Sampler.Close()
 
 #===========================================================================================
 # Try some motion in constant speed mode.
 #===========================================================================================
 def ConstSpeedTest():
     print("Constant speed test")
-    dmm.SendCommand("Set_MainGain", 25)
-    dmm.SendCommand("Set_SpeedGain", 50)
-    dmm.SendCommand("Set_IntGain", 1)
-    dmm.SendCommand("Set_TrqCons", 100)
-    dmm.SendCommand("Set_HighAccel", 30)
-    dmm.SendCommand("Set_HighSpeed", 20)
-    dmm.SendCommand("Set_TrqCons", 80)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 25)
+        dmm.SendCommand("Set_SpeedGain", 50)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 100)
+        dmm.SendCommand("Set_HighAccel", 30)
+        dmm.SendCommand("Set_HighSpeed", 20)
+        dmm.SendCommand("Set_TrqCons", 80)
 
     dmm.SendCommand("Turn_ConstSpeed", -3000)
     start = time.time()
     stop_sent = False
     while True:
-        dmm.ReqMotorSpeed()
+        dmm.ReqMotorSpeed(Track=False)
         dt = time.time()-start
         if dt > 0.5 and not stop_sent:
             print("Set speed zero")
@@ -103,7 +106,7 @@ def ReadPositionTest():
     BlankLine = "|---------"*10+"|"
 
     while True:
-        dmm.ReqPosRead()
+        dmm.ReqPosRead(Track=False)
         time.sleep(0.05)
         dmm.RecvData()
         deg = dmm.ReplyValues[0x1b]*360/65536
@@ -125,7 +128,7 @@ def DriveDisable():
 
     while True:
         dmm.RecvData()
-        dmm.ReqPosRead()
+        dmm.ReqPosRead(Track=False)
         time.sleep(0.1)
 
 
@@ -135,25 +138,26 @@ def DriveDisable():
 def Jog():
     import keyboard # Keyboard module, requires "pip3 install keyboard"
 
-    dmm.SendCommand("Set_MainGain", 10)
-    dmm.SendCommand("Set_SpeedGain", 120)
-    dmm.SendCommand("Set_IntGain", 12)
-    dmm.SendCommand("Set_TrqCons", 127)
-    dmm.SendCommand("Set_HighAccel", 5)
-    dmm.SendCommand("Set_HighSpeed", 5)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 10)
+        dmm.SendCommand("Set_SpeedGain", 120)
+        dmm.SendCommand("Set_IntGain", 12)
+        dmm.SendCommand("Set_TrqCons", 127)
+        dmm.SendCommand("Set_HighAccel", 5)
+        dmm.SendCommand("Set_HighSpeed", 5)
     dmm.RecvData()
     dmm.DriveEnable()
 
     # Initialize the position
     global position
     position = 0
+    Setpoints = dmm.SetpointQueue(50) # Key repeat can outrun the drive.
 
     def update_position(amount):
         global position
         position += amount
         print("Go to deg: %6.2f"%(position))
-        dmm.SendCommand("Go_Absolute_Pos", int(position*16384/360))
-        dmm.RecvData()
+        Setpoints.Send("Go_Absolute_Pos", int(position*16384/360))
 
     # Define key press handlers
     keyboard.on_press_key("d", lambda _: update_position(1))
@@ -167,6 +171,7 @@ def Jog():
 
     # Keep the program running until 'Esc' is pressed
     keyboard.wait('esc')
+    Setpoints.Close()
     dmm.RecvData()
     sys.exit(0)
 
@@ -184,9 +189,10 @@ def Catapult():
     dmm.RecvData()
     dmm.SendCommand("Set_IntGain", 1)
     dmm.RecvData()
-    dmm.SendCommand("Set_TrqCons", 30)
-    dmm.SendCommand("Set_HighAccel", 20) # Max allowed acceleration
-    dmm.SendCommand("Set_HighSpeed", 20)  # Maximum speed
+    with dmm.Batch():
+        dmm.SendCommand("Set_TrqCons", 30)
+        dmm.SendCommand("Set_HighAccel", 20) # Max allowed acceleration
+        dmm.SendCommand("Set_HighSpeed", 20)  # Maximum speed
     dmm.RecvData()
     dmm.SendCommand("Go_Absolute_Pos", 0)
     time.sleep(0.5)
@@ -245,12 +251,13 @@ def Catapult():
 def BackAndForth():
     print("Back and forth parameter update test")
     time.sleep(0.1)
-    dmm.SendCommand("Set_MainGain", 30)
-    dmm.SendCommand("Set_SpeedGain", 5)
-    dmm.SendCommand("Set_IntGain", 1)
-    dmm.SendCommand("Set_TrqCons", 30)
-    dmm.SendCommand("Set_HighAccel", 40) # Max allowed acceleration
-    dmm.SendCommand("Set_HighSpeed", 100)  # Maximum speed
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 30)
+        dmm.SendCommand("Set_SpeedGain", 5)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 30)
+        dmm.SendCommand("Set_HighAccel", 40) # Max allowed acceleration
+        dmm.SendCommand("Set_HighSpeed", 100)  # Maximum speed
     dmm.RecvData()
     dmm.DriveEnable()
     dmm.DriveEnable()
@@ -270,42 +277,75 @@ def BackAndForth():
         dmm.SendCommand("Go_Absolute_Pos", 32768)
         time.sleep(0.5)
 
+#===========================================================================================
+# Back and forth with the motion worked out ahead of time and streamed to the drive,
+# instead of changing HighAccel between moves.  Same every time it's run.
+#===========================================================================================
+def TrajectoryTest():
+    import dmmtraj
+    print("Streamed trajectory test")
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 30)
+        dmm.SendCommand("Set_SpeedGain", 5)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 30)
+        dmm.SendCommand("Set_HighAccel", 127) # Let the trajectory set the acceleration
+        dmm.SendCommand("Set_HighSpeed", 127)
+    dmm.RecvData()
+    dmm.DriveEnable()
+    dmm.SendCommand("Go_Absolute_Pos", 0)
+    time.sleep(0.5)
+
+    Move = dmmtraj.Trapezoid(0, 16384, 40000, 60000)             # Gentle start
+    Move += dmmtraj.Dwell(16384, 0.2)
+    Move += dmmtraj.SCurve(16384, 32768, 40000, 300000, 3000000) # Fast, but no jolt
+    Move += dmmtraj.Dwell(32768, 0.2)
+    Move += dmmtraj.Spline([(0,32768), (0.4,20000), (0.7,24000), (1.2,0)])
+
+    dmm.ShowReplies = False
+    for Run in range(0, 5):
+        Result = dmmtraj.Stream(Move)
+        Dropped = Result.Actual.count(None)
+        print("Run %d: tracking error max %6.0f rms %6.0f  reads dropped:%d  late:%d"%(
+              Run, Result.MaxError or 0, Result.RmsError or 0, Dropped, Result.Late))
+        time.sleep(0.5)
+
 #===========================================================================================
 # Hold position
 #===========================================================================================
 def PositionHold():
     print("Hold position test")
-    dmm.SendCommand("Set_MainGain", 25)
-    dmm.SendCommand("Set_SpeedGain", 50)
-    dmm.SendCommand("Set_IntGain", 30)
-    dmm.SendCommand("Set_TrqCons", 100)
-    dmm.SendCommand("Set_HighAccel", 20)
-    dmm.SendCommand("Set_HighSpeed", 20)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 25)
+        dmm.SendCommand("Set_SpeedGain", 50)
+        dmm.SendCommand("Set_IntGain", 30)
+        dmm.SendCommand("Set_TrqCons", 100)
+        dmm.SendCommand("Set_HighAccel", 20)
+        dmm.SendCommand("Set_HighSpeed", 20)
     dmm.RecvData()
     dmm.DriveEnable()
     dmm.RecvData()
     dmm.ShowReplies = False
+    Sampler = dmm.Sampler({0x1e:1}, Rate=10)
+    Sampler.Start()
     while True:
-        time.sleep(0.08)
-        print("Torque: ",end="")
-        dmm.ReqTorqCurrent()
-        dmm.RecvData()
-        Torque = dmm.ReplyValues[0x1e]
-        Str = ("+" if Torque > 0 else "-")*int(Torque/10)
-        print("%6d"%(Torque),Str+"##")
+        for t, Torque in Sampler.Take(0x1e, timeout=1):
+            Str = ("+" if Torque > 0 else "-")*int(Torque/10)
+            print("Torque: %6d"%(Torque),Str+"##")
 
 #===========================================================================================
 # Move like the second hand on a clock
 #===========================================================================================
 def Clock():
     print("Clock seconds hand test")
-    dmm.SendCommand("Set_MainGain", 18)
-    dmm.SendCommand("Set_SpeedGain", 63)
-    dmm.SendCommand("Set_IntGain", 1)
-    dmm.SendCommand("Set_TrqCons", 63)
-    dmm.SendCommand("Set_HighSpeed", 61)
-    dmm.SendCommand("Set_HighAccel", 47)
-    dmm.SendCommand("Turn_ConstSpeed", 0)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 18)
+        dmm.SendCommand("Set_SpeedGain", 63)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 63)
+        dmm.SendCommand("Set_HighSpeed", 61)
+        dmm.SendCommand("Set_HighAccel", 47)
+        dmm.SendCommand("Turn_ConstSpeed", 0)
 
     dmm.RecvData()
     dmm.DriveEnable()
@@ -313,13 +353,14 @@ def Clock():
     xtra_turns = 0
     #time.sleep(60)
 
+    Tick = dmm.PeriodicSchedule(1.0)
     for a in range (0,1200):
+        Tick.Wait()
         angle = (a/60.0+a*xtra_turns)*16384
         dmm.SendCommand("Go_Absolute_Pos", int(angle))
-        dmm.RecvData()
-        time.sleep(0.99)
 
     dmm.DriveDisable()
+    print("Ticks:", Tick.Summary())
 
 
 #===========================================================================================
@@ -331,25 +372,27 @@ def EncoderAccuracy():
     STEPS_PER_TURN=6400
     #dmm.ShowSerialBytes = True
 
+    Driven = dmm.Drive(20)
+    Driver = dmm.Drive(21)
+
     # Configure both motors
-    for id in range(20,22):
-        dmm.Controller_ID = id
-        print ("Configure controller with id",id)
-        dmm.DriveReset()
+    for motor in (Driven, Driver):
+        print ("Configure controller with id",motor.ID)
+        motor.DriveReset()
         time.sleep(0.2)
-        dmm.DriveDisable()
-        dmm.SendCommand("Set_MainGain", 50)
-        dmm.SendCommand("Set_SpeedGain", 30)
-        dmm.SendCommand("Set_IntGain", 1)
-        dmm.SendCommand("Set_TrqCons", 80)
-        dmm.SendCommand("Set_HighAccel", 20)
-        dmm.SendCommand("Set_HighSpeed", 20)
+        with dmm.Batch():
+            motor.DriveDisable()
+            motor.SendCommand("Set_MainGain", 50)
+            motor.SendCommand("Set_SpeedGain", 30)
+            motor.SendCommand("Set_IntGain", 1)
+            motor.SendCommand("Set_TrqCons", 80)
+            motor.SendCommand("Set_HighAccel", 20)
+            motor.SendCommand("Set_HighSpeed", 20)
         dmm.RecvData()
-        dmm.SendCommand("Set_Origin")
+        motor.SendCommand("Set_Origin")
 
     if not use_stepper:
-        dmm.Controller_ID = 20
-        dmm.DriveEnable()
+        Driven.DriveEnable()
     else:
         import stepper as stepper
 
@@ -363,15 +406,13 @@ def EncoderAccuracy():
 
         angle = int(((a+1)/readings_per_turn)*360)
         if not use_stepper:
-            dmm.SendCommand("Go_Absolute_Pos", int(angle/360*16384))
+            Driven.SendCommand("Go_Absolute_Pos", int(angle/360*16384))
             dmm.RecvData()
             time.sleep(0.2)
 
-            # Read the driving motor's encoder
-            dmm.Controller_ID = 21
-            dmm.ReqPosRead()
-            dmm.RecvData()
-            angle_driver = -dmm.ReplyValues[0x1b]/65536*360
+            # Read both motor's encoders at the same time
+            pos_driven, pos_driver = dmm.ReadAll([Driven, Driver], dmm.GENERAL_READ, 0x1b)
+            angle_driver = None if pos_driver is None else -pos_driver/65536*360
         else:
             abs_steps = int(angle*STEPS_PER_TURN/360)
             dosteps = abs_steps - old_steps
@@ -380,11 +421,14 @@ def EncoderAccuracy():
             angle_driver = angle
             time.sleep(0.3)
 
-        # Read the driven motor's encoder
-        dmm.Controller_ID = 20
-        dmm.ReqPosRead()
-        dmm.RecvData()
-        angle_driven = dmm.ReplyValues[0x1b]/65536*360
+            # Read the driven motor's encoder
+            pos_driven = Driven.ReqPosRead().Result()
+
+        if pos_driven is None or angle_driver is None:
+            print("%7.2f: no reply to position read, skipped"%(angle))
+            differences[a] = None
+            continue
+        angle_driven = pos_driven/65536*360
         diff = angle_driven-angle_driver
         print("%7.2f, %7.2f,   %6.2f"%(angle_driver,angle_driven,diff))
         differences[a] = diff
@@ -392,7 +436,8 @@ def EncoderAccuracy():
     print("\nDegree differences results:")
     for a in range (0, readings_per_turn*2):
         for b in range (0, num_turns, 2):
-            print ("%6.2f"%(differences[a+b*readings_per_turn]), end=",")
+            diff = differences[a+b*readings_per_turn]
+            print ("    --" if diff is None else "%6.2f"%(diff), end=",")
         print("")
     dmm.DriveDisable()
 
@@ -402,13 +447,14 @@ def EncoderAccuracy():
 #===========================================================================================
 def FanSpeed():
     print("Fan max speed test")
-    dmm.SendCommand("Set_MainGain", 2)
-    dmm.SendCommand("Set_SpeedGain", 127)
-    dmm.SendCommand("Set_IntGain", 1)
-    dmm.SendCommand("Set_TrqCons", 127)
-    dmm.SendCommand("Set_HighAccel", 20)
-    dmm.SendCommand("Set_HighSpeed", 30)
-    dmm.SendCommand("Turn_ConstSpeed", 0)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 2)
+        dmm.SendCommand("Set_SpeedGain", 127)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 127)
+        dmm.SendCommand("Set_HighAccel", 20)
+        dmm.SendCommand("Set_HighSpeed", 30)
+        dmm.SendCommand("Turn_ConstSpeed", 0)
     dmm.RecvData()
     dmm.DriveEnable()
 
@@ -423,11 +469,13 @@ def FanSpeed():
     report_str = ""
 
     dmm.ShowReplies = False
+    Sampler = dmm.Sampler({0x1e:1}, Rate=40)
+    Sampler.Start()
     while True:
+        Samples = Sampler.Take(0x1e, timeout=1)
+        if not Samples: continue
+        Torque = Samples[-1][1]
         print("RPM:%4d Torque:"%(set_speed),end="")
-        dmm.ReqTorqCurrent()
-        dmm.RecvData()
-        Torque = dmm.ReplyValues[0x1e]
         numchars = int(abs(Torque) / 10)
         if numchars > 100: numchars = 100
         Str = ("+" if Torque > 0 else "-")*numchars
@@ -464,6 +512,7 @@ def FanSpeed():
             print("Set speed to",set_speed)
             dmm.SendCommand("Turn_ConstSpeed", -set_speed)
 
+    Sampler.Close()
     dmm.DriveDisable()
     #print(report_str)
     ShowDriveStatus()
@@ -474,13 +523,14 @@ def FanSpeed():
 #===========================================================================================
 def WeightLift():
     print("Weight lifting torque test, by turn const speed")
-    dmm.SendCommand("Set_MainGain", 2)
-    dmm.SendCommand("Set_SpeedGain", 127)
-    dmm.SendCommand("Set_IntGain", 1)
-    dmm.SendCommand("Set_TrqCons", 127)
-    dmm.SendCommand("Set_HighAccel", 20)
-    dmm.SendCommand("Set_HighSpeed", 30)
-    dmm.SendCommand("Turn_ConstSpeed", 0)
+    with dmm.Batch():
+        dmm.SendCommand("Set_MainGain", 2)
+        dmm.SendCommand("Set_SpeedGain", 127)
+        dmm.SendCommand("Set_IntGain", 1)
+        dmm.SendCommand("Set_TrqCons", 127)
+        dmm.SendCommand("Set_HighAccel", 20)
+        dmm.SendCommand("Set_HighSpeed", 30)
+        dmm.SendCommand("Turn_ConstSpeed", 0)
     dmm.RecvData()
     dmm.DriveEnable()
 
@@ -504,19 +554,21 @@ def WeightLiftPos1Kg(NoSlack):
     print("Weight lifting torque test by go absolute position")
 
     if NoSlack: # Gentle enough so the rope doesn't go slack
-        dmm.SendCommand("Set_MainGain", 5)
-        dmm.SendCommand("Set_SpeedGain", 1)
-        dmm.SendCommand("Set_IntGain", 2)
-        dmm.SendCommand("Set_TrqCons", 127)
-        dmm.SendCommand("Set_HighAccel", 4)
-        dmm.SendCommand("Set_HighSpeed", 80)
+        with dmm.Batch():
+            dmm.SendCommand("Set_MainGain", 5)
+            dmm.SendCommand("Set_SpeedGain", 1)
+            dmm.SendCommand("Set_IntGain", 2)
+            dmm.SendCommand("Set_TrqCons", 127)
+            dmm.SendCommand("Set_HighAccel", 4)
+            dmm.SendCommand("Set_HighSpeed", 80)
     else:
-        dmm.SendCommand("Set_MainGain", 4)
-        dmm.SendCommand("Set_SpeedGain", 1)
-        dmm.SendCommand("Set_IntGain", 2)
-        dmm.SendCommand("Set_TrqCons", 127)
-        dmm.SendCommand("Set_HighAccel", 10)
-        dmm.SendCommand("Set_HighSpeed", 80)
+        with dmm.Batch():
+            dmm.SendCommand("Set_MainGain", 4)
+            dmm.SendCommand("Set_SpeedGain", 1)
+            dmm.SendCommand("Set_IntGain", 2)
+            dmm.SendCommand("Set_TrqCons", 127)
+            dmm.SendCommand("Set_HighAccel", 10)
+            dmm.SendCommand("Set_HighSpeed", 80)
     
     dmm.SendCommand("Set_Origin")
     dmm.SendCommand("Turn_ConstSpeed", 0)
@@ -535,23 +587,28 @@ def WeightLiftPos1Kg(NoSlack):
 #===========================================================================================
 # Find port or specify the serial port and motor controller
 #===========================================================================================
-if len(sys.argv) > 1 and (sys.argv[1] == "find" or sys.argv[1].startswith("COM")):
-    dmm.Controller_ID = 1000000000
+if len(sys.argv) > 1 and (sys.argv[1] == "find" or sys.argv[1].startswith("COM")
+                          or sys.argv[1].startswith("/dev/") or dmm.IsServerSocket(sys.argv[1])):
+    Found = False
     if sys.argv[1] == "find":
         ret = dmm.FindController()
         if ret:
             print("DMM controller found at %s, id=%d"%(ret))
+            Found = True
         sys.argv.pop(1)
-    elif sys.argv[1].startswith("COM"):
+    else:
         try:
             dmm.OpenSerial(sys.argv[1],0x7f)
-            dmm.Controller_ID = dmm.GetDeviceId()
         except:
             print("Port",sys.argv[1],"Does not exist")
             sys.exit(-1)
+        id = dmm.GetDeviceId()
+        if id is not None:
+            dmm.Controller_ID = id
+            Found = True
         sys.argv.pop(1)
 
-    if dmm.Controller_ID == 1000000000:
+    if not Found:
         print("No DMM controller found")
         sys.exit(-1)
 
@@ -563,9 +620,13 @@ else:
         default_port = "COM5"
     else:
         default_port = "/dev/ttyS0"
+    if dmm.IsServerSocket(dmm.ServerSocket):
+        default_port = dmm.ServerSocket # dmmserver.py is running, go thru it.
     print("use default port %s, DMM driver id %d"%(default_port, 0))
     dmm.OpenSerial(default_port,20)
 
+dmm.StartReader() # Decode replies as they arrive so WaitForReply returns right away.
+dmm.StartTxScheduler() # So Control-C's DriveDisable doesn't wait behind queued queries.
 dmm.ShowReplies = True
 dmm.ShowSerialByttes = False
 #===========================================================================================
@@ -576,6 +637,8 @@ if len(sys.argv) > 1:
     if argument == "mon": # Used to monitor serial communications by connecting DMM
                           # controller's serial tx to a second serial port's rx.
         print("Monitoring serial")
+        if len(sys.argv) > 2: # Also record it to a capture file.
+            dmm.StartCapture(sys.argv[2])
         while True:  dmm.RecvData()
     elif argument == "readall": ReadAllParameters()
     elif argument == "status": ShowDriveStatus()
@@ -590,6 +653,7 @@ if len(sys.argv) > 1:
     elif argument == "catapult": Catapult()
     elif argument == "jog": Jog()
     elif argument == "bf": BackAndForth()
+    elif argument == "traj": TrajectoryTest()
     elif argument == "hold": PositionHold()
     elif argument == "clock": Clock()
     elif argument == "enc": EncoderAccuracy()
@@ -0,0 +1,134 @@
+# asyncio interface to the DMM servo controller.
+#
+# For programs that already run an asyncio event loop.  Uses the same command
+# table and frame encoding/decoding as dmmlib, but none of its globals, so
+# it doesn't need threads or time.sleep() calls.
+#
+#   drive = await dmmasync.OpenDrive("/dev/ttyS0")
+#   await drive.set_gain(main=30, speed=5)
+#   print(await drive.read_position())
+#   async for t, ReplyId, Value in drive.telemetry(50):
+#       ...
+#
+# Requires "pip3 install pyserial-asyncio"
+import asyncio
+from collections import deque
+import dmmlib as dmm
+
+class AsyncDrive(asyncio.Protocol):
+    def __init__(self, ID=0x7f):
+        self.id = ID  # Device ID commands are sent to, 0x7f for "any"
+        self.transport = None
+        self.parser = dmm.FrameParser(self.frame_received)
+        self.pending = {} # Deque of (ReplyId, future) waiting for a reply for each
+                          # device ID, in the order the requests went out
+        self.reply_values = [None]*32 # Last value of each reply
+
+    #---------------------------------------------------------------------------
+    # asyncio.Protocol callbacks
+    #---------------------------------------------------------------------------
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.parser.Feed(data)
+
+    def connection_lost(self, exc):
+        for Waiting in self.pending.values():
+            for ReplyId, future in Waiting:
+                if not future.done(): future.set_result(None)
+        self.pending = {}
+
+    def frame_received(self, Frame):
+        Decoded = dmm.DecodeFrame(Frame)
+        if not Decoded: return
+        DeviceId, ReplyId, Value = Decoded
+        if DeviceId == 0x7f: return # Echo of a command, not a reply.
+
+        self.reply_values[ReplyId] = Value
+        # The drive answers in order, so requests before the one this answers got
+        # dropped (like dmmlib's ResolvePendingRead).  Requests sent to 0x7f get
+        # answered with the drive's own ID.
+        for Id in (DeviceId, 0x7f):
+            Waiting = self.pending.get(Id)
+            if not Waiting: continue
+            for n in range(0, len(Waiting)):
+                if Waiting[n][0] == ReplyId: break
+            else:
+                continue
+            for k in range(0, n):
+                Dropped = Waiting.popleft()[1]
+                if not Dropped.done(): Dropped.set_result(None)
+            future = Waiting.popleft()[1]
+            if not future.done(): future.set_result(Value)
+            return
+
+    #---------------------------------------------------------------------------
+    # Sending commands
+    #---------------------------------------------------------------------------
+    def send(self, Command, Value=0):
+        if isinstance(Command, str): Command = dmm.SendCommandIds[Command]
+        self.transport.write(dmm.MakeFrame(self.id, Command, Value))
+
+    # Send a command and wait for its reply.  Returns None on timeout, or if the
+    # drive answered a later request instead (it dropped this one).
+    async def read(self, Command, Value=0, timeout=0.1):
+        if isinstance(Command, str): Command = dmm.SendCommandIds[Command]
+        ReplyId = dmm.CommandReplyId(Command, Value)
+        if ReplyId is None:
+            raise ValueError(dmm.CommandName(Command, Value)+" has no reply, use send()")
+        future = asyncio.get_running_loop().create_future()
+        entry = (ReplyId, future)
+        Waiting = self.pending.setdefault(self.id, deque())
+        Waiting.append(entry)
+        self.send(Command, Value)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if entry in Waiting: Waiting.remove(entry)
+            return None
+
+    async def read_position(self): return await self.read(dmm.GENERAL_READ, 0x1b)
+    async def read_speed(self):    return await self.read(dmm.GENERAL_READ, 0x1d)
+    async def read_torque(self):   return await self.read(dmm.GENERAL_READ, 0x1e)
+    async def read_status(self):   return await self.read("Read_Drive_Status")
+    async def read_param(self, name): return await self.read("Read_"+name) # eg. "MainGain"
+
+    async def set_param(self, name, Value): self.send("Set_"+name, Value)
+
+    async def set_gain(self, main=None, speed=None, integral=None):
+        if main is not None:     self.send("Set_MainGain", main)
+        if speed is not None:    self.send("Set_SpeedGain", speed)
+        if integral is not None: self.send("Set_IntGain", integral)
+
+    async def go_absolute(self, Pos): self.send("Go_Absolute_Pos", Pos)
+    async def turn_const_speed(self, Speed): self.send("Turn_ConstSpeed", Speed)
+    async def enable(self):  self.send(dmm.GENERAL_READ, 0x20)
+    async def disable(self): self.send(dmm.GENERAL_READ, 0x21)
+    async def reset(self):   self.send(dmm.GENERAL_READ, 0x1c)
+
+    #---------------------------------------------------------------------------
+    # Stream telemetry: yields (time, ReplyId, Value) for each of the General_Read
+    # IDs in "what" (0x1b position, 0x1d speed, 0x1e torque), rate times a second.
+    # Value is None for reads that got dropped.
+    #---------------------------------------------------------------------------
+    async def telemetry(self, rate=50, what=(0x1b,)):
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
+        while True:
+            for ReplyId in what:
+                t = loop.time()
+                yield t, ReplyId, await self.read(dmm.GENERAL_READ, ReplyId)
+            next_time += 1/rate
+            await asyncio.sleep(max(0, next_time - loop.time()))
+
+#===========================================================================================
+# Open the serial port and return an AsyncDrive talking to it.
+#===========================================================================================
+async def OpenDrive(port, ID=0x7f, baud=38400):
+    import serial_asyncio # Requires "pip3 install pyserial-asyncio"
+    loop = asyncio.get_running_loop()
+    transport, drive = await serial_asyncio.create_serial_connection(
+                            loop, lambda: AsyncDrive(ID), port, baudrate=baud)
+    drive.transport = transport # connection_made() only gets called on next loop pass.
+    return drive
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# Replay serial traffic recorded with dmmlib.StartCapture() (or "dmm.py mon file")
+#
+# Feeds the recorded bytes back thru the dmmlib decoder, so problems seen in the
+# field can be looked at later, and changes to the decoder can be benchmarked
+# against real traffic.
+#
+# Usage:
+#   python3 dmmcapture.py capture.bin             Print decoded replies, full speed
+#   python3 dmmcapture.py capture.bin realtime    Same, with the original timing
+#   python3 dmmcapture.py capture.bin bench       Just decode and report how fast
+#   python3 dmmcapture.py capture.bin bulk        Decode with numpy, print a summary
+import sys, time
+import dmmlib as dmm
+
+#===========================================================================================
+# Read a capture file, yields (time, direction, bytes) for each recorded chunk.
+#===========================================================================================
+def ReadCapture(FileName):
+    with open(FileName, "rb") as File:
+        data = File.read()
+    if not data.startswith(dmm.CAPTURE_MAGIC):
+        raise ValueError(FileName+" is not a dmmlib capture file")
+
+    RecordSize = dmm.CAPTURE_RECORD.size
+    a = len(dmm.CAPTURE_MAGIC)
+    while a + RecordSize <= len(data):
+        t, Direction, Length = dmm.CAPTURE_RECORD.unpack_from(data, a)
+        a += RecordSize
+        yield t, Direction, data[a:a+Length]
+        a += Length
+
+#===========================================================================================
+# Feed the received bytes of a capture thru the decoder.
+# Returns number of bytes replayed.
+#===========================================================================================
+def Replay(FileName, RealTime=False):
+    NumBytes = 0
+    StartTime = None
+    for t, ChunkDirection, data in ReadCapture(FileName):
+        if ChunkDirection != dmm.CAPTURE_RECEIVED: continue
+        if RealTime:
+            if StartTime is None: StartTime = time.monotonic() - t
+            wait = t + StartTime - time.monotonic()
+            if wait > 0: time.sleep(wait)
+        dmm.FeedParser(data)
+        NumBytes += len(data)
+    return NumBytes
+
+#===========================================================================================
+# Decode all the received frames of a capture at once using numpy.
+# Much faster than feeding the bytes thru DecodeCmd one frame at a time, for
+# looking at long captures.  Returns a dictionary of equal length arrays:
+#   "time", "device_id", "reply_id", "value"
+# Frames with bad checksums or that got cut short are left out.  Echoes (device
+# ID 0x7f) are left out too unless IncludeEchoes is set.
+#===========================================================================================
+def BulkDecode(FileName, IncludeEchoes=False):
+    import numpy as np # Requires "pip3 install numpy"
+
+    with open(FileName, "rb") as File:
+        data = File.read()
+    if not data.startswith(dmm.CAPTURE_MAGIC):
+        raise ValueError(FileName+" is not a dmmlib capture file")
+
+    # Find where each record starts.  This has to be done one record at a time,
+    # but it's just following the lengths, there's a lot fewer records than bytes.
+    RecordSize = dmm.CAPTURE_RECORD.size
+    Offsets = []
+    Append = Offsets.append
+    a = len(dmm.CAPTURE_MAGIC)
+    end = len(data) - RecordSize
+    while a <= end:
+        Append(a)
+        a += RecordSize + data[a+9] + (data[a+10] << 8)
+    Offsets = np.array(Offsets, dtype=np.int64)
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    Times = raw[Offsets[:,None] + np.arange(8)].copy().view("<f8").ravel()
+    Directions = raw[Offsets+8]
+    Lengths = raw[Offsets+9].astype(np.int64) | raw[Offsets+10].astype(np.int64) << 8
+    if len(Offsets):
+        Lengths[-1] = min(Lengths[-1], len(data)-Offsets[-1]-RecordSize) # Truncated file
+
+    # Gather the received bytes into one stream, with the time of each byte.
+    Rx = Directions == dmm.CAPTURE_RECEIVED
+    Starts = Offsets[Rx] + RecordSize
+    Lengths = Lengths[Rx]
+    Before = np.cumsum(Lengths) - Lengths
+    Index = np.repeat(Starts - Before, Lengths) + np.arange(Lengths.sum())
+    b = raw[Index]
+    ByteTimes = np.repeat(Times[Rx], Lengths)
+    n = len(b)
+
+    # Frames start with a byte that has bit 7 clear.  A frame is complete if all
+    # its bytes are there before the next frame start.
+    s = np.flatnonzero(b & 0x80 == 0)
+    s = s[s+1 < n]
+    NextStart = np.append(s[1:], n)
+    FrameLen = ((b[s+1].astype(np.int64) >> 5) & 3) + 4
+    Complete = s + FrameLen <= NextStart
+    s = s[Complete]
+    FrameLen = FrameLen[Complete]
+    Last = s + FrameLen - 1
+
+    # Checksum is the low 7 bits of the sum of all bytes before it.
+    Sums = np.concatenate(([0], np.cumsum(b, dtype=np.int64)))
+    Good = (Sums[Last] - Sums[s]) & 0x7f == b[Last] & 0x7f
+    s = s[Good]
+    FrameLen = FrameLen[Good]
+
+    # Values are sent MSB first, 7 bits per byte, first byte sign extended.
+    Value = (b[s+2] & 0x7f).astype(np.int64)
+    Value = np.where(Value >= 64, Value-128, Value)
+    for k in range(1, 4):
+        HasByte = FrameLen-3 > k
+        Byte = b[np.where(HasByte, s+2+k, s)] & 0x7f
+        Value = np.where(HasByte, Value << 7 | Byte, Value)
+
+    DeviceId = b[s]
+    ReplyId = b[s+1] & 0x1f
+    # Control parameters are only in range 1-127, so treat as unsigned byte.
+    Value = np.where(np.isin(ReplyId, dmm.SingleByteReplies), Value & 127, Value)
+
+    Keep = slice(None) if IncludeEchoes else DeviceId != 0x7f
+    return {"time":ByteTimes[s][Keep], "device_id":DeviceId[Keep],
+            "reply_id":ReplyId[Keep], "value":Value[Keep]}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: dmmcapture.py <capture file> [realtime|bench|bulk]")
+        sys.exit(-1)
+
+    options = sys.argv[2:]
+    if "bulk" in options:
+        start = time.perf_counter()
+        Frames = BulkDecode(sys.argv[1])
+        elapsed = time.perf_counter() - start
+        print("Decoded %d frames in %.3f seconds"%(len(Frames["time"]), elapsed))
+        for ReplyId in sorted(set(Frames["reply_id"].tolist())):
+            Values = Frames["value"][Frames["reply_id"] == ReplyId]
+            print("%-12s count:%8d  min:%9d  max:%9d"%(dmm.RecvReplyIds[ReplyId],
+                  len(Values), Values.min(), Values.max()))
+        sys.exit(0)
+
+    if "bench" in options:
+        dmm.ShowReplies = False
+
+    start = time.perf_counter()
+    NumBytes = Replay(sys.argv[1], "realtime" in options)
+    elapsed = time.perf_counter() - start
+
+    print("Replayed %d bytes, %d frames decoded in %.3f seconds"%(
+            NumBytes, dmm.ReplysDecoded, elapsed))
+    if "bench" in options and elapsed:
+        print("%.0f bytes/s, %.0f frames/s"%(NumBytes/elapsed, dmm.ReplysDecoded/elapsed))
+    dmm.PrintStats()
@@ -4,7 +4,8 @@
 # Tested with DYN2-T 1A6S-00 sevo controller
 #
 # Matthias Wandel Jauary 2025 - March 2025
-import sys, time
+import sys, os, glob, stat, math, time, threading, bisect, struct, socket, select, array, atexit
+from collections import deque
 import serial  # Requires "pip3 instll pyserial" for serial to be enabled.
 
 # Commands sent to the controller (Page 46 of PDF)
@@ -24,6 +25,17 @@ SendCommandIds = {
 
 GENERAL_READ = 0x0e
 
+# Read commands and the ID of the reply they generate.
+# General_Read replies with the ID it was passed as value (0x1b, 0x1d or 0x1e)
+ReadReplyIds = {
+    0x06:0x16, # Read_Drive_ID
+    0x08:0x1a, # Read_Drive_Config
+    0x09:0x19, # Read_Drive_Status
+    0x18:0x10, 0x19:0x11, 0x1a:0x12, # MainGain, SpeedGain, IntGain
+    0x1b:0x13, 0x1c:0x14, 0x1d:0x15, # TrqCons, HighSpeed, HighAccel
+    0x1e:0x17, 0x1f:0x18             # Pos_OnRange, GearNumber
+}
+
 # Make reverse lookup dictionary for the commands
 SendCommandLookup = {}
 for key in SendCommandIds: SendCommandLookup[SendCommandIds[key]] = key
@@ -42,82 +54,457 @@ RecvReplyIds = {
 }
 
 ReplyValues = [1000000000]*32
+ReplyCounts = [0]*32 # Number of times each reply was decoded, for WaitForReply
 ReplysDecoded = 0
+ChecksumErrors = 0
+FormatErrors = 0
 
 SaveDecoded = False
 DecodedQueue = []
+ReplyListeners = [] # Functions called with (DeviceId, ReplyId, Value) of every reply
+
+ShowSerialBytes = False
+ShowEchoReplies = True
+ShowReplies = True
+
+# Reply ID that a command will generate, or None if it doesn't generate a reply.
+def CommandReplyId(Command, Value=0):
+    if Command == GENERAL_READ:
+        return Value if Value in (0x1b, 0x1d, 0x1e) else None
+    return ReadReplyIds.get(Command)
+
+#===========================================================================================
+# Cache of the gain and limit parameters the drive is known to have, by device ID.
+# With ParamCaching = True, Set_ commands for a value the drive already has are
+# skipped, so sliders and scripts that keep sending the same values don't use up
+# serial bandwidth the telemetry needs (and make the controller drop queries).
+# Only values the drive confirmed go in the cache, from the replies to Read_ requests
+# sent after the last Set_ of that parameter.  So after a Set_, read it back with
+# ReadParam(Name, Fresh=True) before sets of the same value get skipped.  A Set_ the
+# drive dropped never gets confirmed, so it gets sent again.
+# Values are forgotten on DriveReset, but the cache can't tell if the drive was power
+# cycled, so it's off unless you turn it on.  Never used thru dmmserver.py, the other
+# programs using the drive may change the parameters.
+#===========================================================================================
+SetParamReplyIds = {0x10:0x10, 0x11:0x11, 0x12:0x12, 0x13:0x13, 0x14:0x14, 0x15:0x15,
+                    0x16:0x17, 0x17:0x18} # Set_ command, and reply ID it reads back as
+ParamReplyIds = set(SetParamReplyIds.values())
+ParamCaching = False
+ParamCache = {} # {Reply ID:value} dictionary for each device ID
+ParamSetTimes = {} # time.monotonic() of the last Set_, by (device ID, reply ID)
+ParamSetsSkipped = 0
+
+def UseParamCache():
+    return ParamCaching and not isinstance(ser, ServerPort)
+
+def CacheParam(DeviceId, ReplyId, Value):
+    if DeviceId == 0x7f:
+        # Sent to all drives
+        for Params in ParamCache.values(): Params[ReplyId] = Value
+    ParamCache.setdefault(DeviceId, {})[ReplyId] = Value
+
+def ParamCached(DeviceId, ReplyId, Value):
+    if DeviceId == 0x7f:
+        # Only skip if every drive we know of has it already.
+        return bool(ParamCache) and all(Params.get(ReplyId) == Value
+                                        for Params in ParamCache.values())
+    return ParamCache.get(DeviceId, {}).get(ReplyId) == Value
+
+def ForgetParams(DeviceId=0x7f):
+    if DeviceId == 0x7f:
+        ParamCache.clear()
+    else:
+        ParamCache.pop(DeviceId, None)
+        ParamCache.pop(0x7f, None)
+
+# A Set_ is being sent, its value isn't known till it's read back.
+def ParamSet(DeviceId, ReplyId):
+    ParamSetTimes[(DeviceId, ReplyId)] = time.monotonic()
+    for Id, Params in ParamCache.items():
+        if DeviceId == 0x7f or Id in (DeviceId, 0x7f): Params.pop(ReplyId, None)
+
+# Reply to a Read_ requested at RequestTime.  Only counts if it was requested after
+# the last Set_ (so it went out after it too), else it may be the value from before.
+def ConfirmParam(DeviceId, ReplyId, Value, RequestTime):
+    LastSet = max(ParamSetTimes.get((DeviceId, ReplyId), 0), ParamSetTimes.get((0x7f, ReplyId), 0))
+    if RequestTime > LastSet: CacheParam(DeviceId, ReplyId, Value)
+
+# Read a parameter, eg. ReadParam("MainGain").  Comes from the cache if it's
+# in there and caching is on, unless Fresh is set.  Returns None if the drive
+# doesn't reply.
+def ReadParam(Param, Fresh=False, id=-1, timeout=0.1):
+    Command = SendCommandIds["Read_"+Param]
+    if not Fresh and UseParamCache():
+        DeviceId = (id if id else Controller_ID) & 0x7f
+        Value = ParamCache.get(DeviceId, {}).get(ReadReplyIds[Command])
+        if Value is not None: return Value
+    return SendCommand(Command, 0, id).Result(timeout)
+
+#===========================================================================================
+# Build the bytes of one command or reply frame.
+# Also used by dmmsim.py to build the replies of the virtual drive.
+# The value is sent MSB first, 7 bits per byte, using as few bytes as will hold it
+# (sign extended), the number of value bytes goes in the length bits of the 2nd byte.
+#===========================================================================================
+def MakeFrame(DeviceId, Command, Value=0):
+    DeviceId &= 0x7f
+    Command &= 0x1f
+    if -0x40 <= Value < 0x40:
+        Frame = [DeviceId, 0x80 | Command, 0x80 | Value & 0x7f]
+    elif -0x2000 <= Value < 0x2000:
+        Frame = [DeviceId, 0xa0 | Command, 0x80 | (Value >> 7) & 0x7f, 0x80 | Value & 0x7f]
+    elif -0x100000 <= Value < 0x100000:
+        Frame = [DeviceId, 0xc0 | Command, 0x80 | (Value >> 14) & 0x7f,
+                 0x80 | (Value >> 7) & 0x7f, 0x80 | Value & 0x7f]
+    else:
+        Frame = [DeviceId, 0xe0 | Command, 0x80 | (Value >> 21) & 0x7f,
+                 0x80 | (Value >> 14) & 0x7f, 0x80 | (Value >> 7) & 0x7f, 0x80 | Value & 0x7f]
+
+    Frame.append(0x80 | sum(Frame) & 0x7f) # Checksum byte
+    return bytes(Frame)
+
+#===========================================================================================
+# Transmit scheduler.  Normally frames get written in the order they are sent.  After
+# StartTxScheduler() they are queued by priority instead, safety > commands >
+# telemetry, and written no faster than the wire carries them, so there's never much
+# more than one frame waiting in the serial driver.
+# Drive disable and reset skip the queues and get written right away, so they reach
+# the wire within one frame time no matter how many telemetry queries are queued.
+# Motion and configuration commands share one queue, so they go out in the order they
+# were sent -- a Set_HighSpeed before a Go_Absolute_Pos has to get there first.
+# A full telemetry queue drops its oldest query (its reply will time out), the other
+# queue makes the sender wait.
+# What's still queued gets sent when the program exits, or on StopTxScheduler().
+#===========================================================================================
+TX_SAFETY, TX_MOTION, TX_TELEMETRY = 0, 1, 2
+TX_CONFIG = TX_MOTION # Same queue, to keep Set_ and motion commands in order
+TxMaxQueued = 32     # Frames per priority queue
+TxQueues = None
+TxThread = None
+TxRunning = False
+TxDrained = True     # TxLoop has sent everything and stopped, nothing more gets queued
+TxCondition = threading.Condition()
+TxDropped = 0        # Telemetry queries dropped because the queue was full
+TxByteTime = 10/38400
+TxLineFree = 0       # time.monotonic() when the wire is done with what was written
+WriteLock = threading.Lock()
+
+def CommandPriority(Command, Value=0):
+    if Command == GENERAL_READ:
+        if Value in (0x21, 0x1c): return TX_SAFETY # Disable, reset
+        return TX_MOTION if Value == 0x20 else TX_TELEMETRY
+    if Command in ReadReplyIds: return TX_TELEMETRY
+    return TX_MOTION # Motion and configuration
+
+# Returns False if the scheduler has stopped, then the caller writes it directly.
+def QueueFrame(data, Priority, Pending=()):
+    global TxDropped
+    with TxCondition:
+        if TxDrained: return False
+        Queue = TxQueues[Priority]
+        if Priority == TX_TELEMETRY and len(Queue) >= TxMaxQueued:
+            for Request in Queue.popleft()[1]:
+                Request.Dropped = Request.Done = True # Never sent, no reply coming.
+            TxDropped += 1
+        while len(Queue) >= TxMaxQueued and TxRunning:
+            TxCondition.wait(0.1)
+        Queue.append((data, Pending))
+        TxCondition.notify_all()
+        return True
+
+def TxLoop():
+    global TxDrained
+    while True:
+        with TxCondition:
+            while TxRunning and not any(TxQueues): TxCondition.wait()
+            if not any(TxQueues):
+                # Stopped, and all sent.  Anything sent from now on gets written directly.
+                TxDrained = True
+                return
+            wait = TxLineFree - time.monotonic()
+            if wait > 0:
+                # Pick what to send when the wire is free, something more important
+                # may get queued meanwhile.
+                TxCondition.wait(wait)
+                continue
+            for Queue in TxQueues:
+                if Queue:
+                    data, Pending = Queue.popleft()
+                    break
+            TxCondition.notify_all() # Room in the queue now.
+        WriteToPort(data, Pending)
+
+TxAtExit = False
+def StartTxScheduler():
+    global TxQueues, TxThread, TxRunning, TxDrained, TxByteTime, TxAtExit
+    if TxThread: return
+    TxByteTime = 10/getattr(ser, "baudrate", 38400)
+    TxQueues = [deque() for Priority in range(TX_SAFETY, TX_TELEMETRY+1)]
+    TxRunning = True
+    TxDrained = False
+    TxThread = threading.Thread(target=TxLoop, daemon=True)
+    TxThread.start()
+    if not TxAtExit:
+        # Else a script that sends something and exits would lose what's still queued.
+        atexit.register(StopTxScheduler)
+        TxAtExit = True
+
+# Stops after what's queued has been sent.
+def StopTxScheduler():
+    global TxThread, TxRunning
+    if not TxThread: return
+    with TxCondition:
+        TxRunning = False
+        TxCondition.notify_all()
+    TxThread.join()
+    TxThread = None
 
 #===========================================================================================
 # Send a command to the servo controller
+#
+# Frames that don't change (drive enable/disable, read requests and so on) are only
+# built once, and kept in FrameCache along with the reply they generate.  Commands
+# with a value that keeps changing (positions, speeds) aren't cached.
 #===========================================================================================
-def SendCommand(Command, Value=0, id = -1):
-    global ShowSerialBytes
+FrameCache = {} # (DeviceId, Command, Value) -> (Frame, ReplyId, Command name, priority)
+UncachedCommands = {0x01, 0x02, 0x03, 0x04, 0x0a, 0x0b, 0x0c, 0x0d} # Motion commands
 
-    if not -1 <= (Value >> 27) <= 0:
-        print ("Value is out of 28 bit range")
-        return
+def SendCommand(Command, Value=0, id = -1, Track=True):
+    global ShowSerialBytes, ParamSetsSkipped
 
     if isinstance(Command, str):
         # you can also pass the command as a string, for clarity but not efficiency.
         Command = SendCommandIds[Command]
 
-    CmdToSend = [0]*2
-    if id:
-        CmdToSend[0] = id & 0x7f
+    DeviceId = id if id else Controller_ID
+    if Command in SetParamReplyIds and UseParamCache() \
+            and ParamCached(DeviceId & 0x7f, SetParamReplyIds[Command], Value):
+        ParamSetsSkipped += 1
+        return None
+
+    Cached = None if Command in UncachedCommands else FrameCache.get((DeviceId, Command, Value))
+    if Cached:
+        CmdToSend, ReplyId, Name, Priority = Cached
     else:
-        CmdToSend[0] = Controller_ID
+        if not -1 <= (Value >> 27) <= 0:
+            print ("Value is out of 28 bit range")
+            return
+
+        if Command >= 0x10 and Command <= 0x14:
+            if Value < 1 or Value > 127:
+                print("Error: Motion gain parameter outside valid range")
+
+        CmdToSend = MakeFrame(DeviceId, Command, Value)
 
-    CmdToSend[1] = 0x80 | Command & 0x1f
+        # Commands that generate a reply get a PendingRead to wait on.
+        ReplyId = CommandReplyId(Command, Value)
+        Name = CommandName(Command, Value) if ReplyId is not None else None
+        Priority = CommandPriority(Command, Value)
+        if Command not in UncachedCommands:
+            FrameCache[(DeviceId, Command, Value)] = (CmdToSend, ReplyId, Name, Priority)
 
-    if Command >= 0x10 and Command <= 0x14:
-        if Value < 1 or Value > 127:
-            print("Error: Motion gain parameter outside valid range")
+    Pending = None
+    if ReplyId is not None and Track:
+        Pending = PendingRead(DeviceId & 0x7f, ReplyId, Name)
 
-    # Send value MSB first
-    for ShiftAmount in range (7*3,-7, -7):
-        if ShiftAmount:
-            if -1 <= (Value >> (ShiftAmount-1)) <= 0:
-                continue # Not sending sign extended bits.
+    if ShowSerialBytes: print ("Sending: ",CmdToSend)
 
-        CmdToSend.append(0x80 | (Value >> ShiftAmount) & 0x7f)
+    if Command in SetParamReplyIds:
+        ParamSet(DeviceId & 0x7f, SetParamReplyIds[Command])
+    elif Command == GENERAL_READ and Value == 0x1c:
+        ForgetParams(DeviceId & 0x7f) # Drive reset
 
-    CmdToSend[1] |= (len(CmdToSend)-3) << 5 # Add the two length bits to second byte.
+    WriteSerial(CmdToSend, Priority, (Pending,) if Pending else ())
+    return Pending
 
-    # Calculate and add checksum byte
-    sum = 0
-    for b in CmdToSend: sum += b
-    CmdToSend.append((sum & 0x7f) | 0x80)
+# Fast versions for streaming positions or speeds at hundreds per second.
+# These skip the checks SendCommand does, Value must be in 28 bit range.
+def GoAbsolutePos(Pos, id=-1):
+    WriteSerial(MakeFrame(id if id else Controller_ID, 0x01, Pos), TX_MOTION)
 
-    if ShowSerialBytes: print ("Sending: ",bytes(CmdToSend))
+def TurnConstSpeed(Speed, id=-1):
+    WriteSerial(MakeFrame(id if id else Controller_ID, 0x0a, Speed), TX_MOTION)
 
-    ser.write(bytes(CmdToSend))
+#===========================================================================================
+# All serial reads and writes go thru these, so bytes in and out can be counted.
+#===========================================================================================
+# Pending is the PendingReads of the requests in data, if any.
+def WriteSerial(data, Priority=TX_MOTION, Pending=()):
+    if Priority != TX_SAFETY:
+        Batching = getattr(BatchState, "Batch", None)
+        if Batching:
+            Batching.Frames.append((data, Pending)) # Gets written when the batch ends.
+            Batching.Pending += Pending
+            Batching.Priority = min(Batching.Priority, Priority)
+            return
+        if TxThread and QueueFrame(data, Priority, Pending): return
+    WriteToPort(data, Pending)
+
+def WriteToPort(data, Pending=()):
+    global BytesOut, TxLineFree
+    with WriteLock:
+        BytesOut += len(data)
+        if CaptureFile: CaptureChunk(CAPTURE_SENT, data)
+        now = time.monotonic()
+        TxLineFree = max(TxLineFree, now) + len(data)*TxByteTime
+        if Pending: AddOutstanding(Pending, now, TxLineFree-now)
+        ser.write(data)
+
+RxTime = 0 # time.monotonic() when the bytes being decoded were read
+def FeedParser(data):
+    global BytesIn, RxTime
+    if not data: return
+    RxTime = time.monotonic()
+    BytesIn += len(data)
+    if CaptureFile: CaptureChunk(CAPTURE_RECEIVED, data)
+    Parser.Feed(data)
+
+#===========================================================================================
+# Collect commands and send them all with one write, instead of one write per command.
+#   with dmm.Batch() as b:
+#       dmm.SendCommand("Set_MainGain", 25)
+#       dmm.SendCommand("Set_SpeedGain", 50)
+#       dmm.ReqDriveStatus()
+#   print(b.ExpectedReplies, b.Pending[0].Result())
+# If Gap is set, the frames are written one at a time at least Gap seconds apart,
+# for in case the controller can't take them back to back.
+# If the with block raises an exception, nothing in the batch gets sent, so a half
+# built set of parameters never reaches the drive.  A batch inside another one
+# becomes part of the outer one.
+# Only collects commands sent from the thread that started the batch.
+#===========================================================================================
+BatchState = threading.local()
+
+class Batch:
+    def __init__(self, Gap=0):
+        self.Gap = Gap
+        self.Frames = []  # (frame, its PendingReads)
+        self.Pending = [] # PendingRead for each command in the batch that gets a reply
+        self.ExpectedReplies = 0
+        self.Priority = TX_TELEMETRY # Most urgent of the frames in it
+        self.Outer = None
+
+    def __enter__(self):
+        self.Outer = getattr(BatchState, "Batch", None)
+        BatchState.Batch = self
+        return self
+
+    def __exit__(self, *args):
+        BatchState.Batch = self.Outer
+        if args[0] is not None:
+            # Exception in the with block, send none of it.
+            for Pending in self.Pending: Pending.Dropped = Pending.Done = True
+            self.Frames = []
+            self.Pending = []
+        self.ExpectedReplies = len(self.Pending)
+        if not self.Frames: return
+        if self.Gap:
+            for n in range(0, len(self.Frames)):
+                if n: time.sleep(self.Gap)
+                WriteSerial(self.Frames[n][0], self.Priority, self.Frames[n][1])
+        else:
+            WriteSerial(b"".join(f[0] for f in self.Frames), self.Priority, tuple(self.Pending))
+
+#===========================================================================================
+# Record all serial traffic to a file, for looking at problems later.
+# File is "DMMCAP1\n" followed by records of:
+#    time.monotonic() as double, direction byte, 16 bit length, then the bytes
+# all little endian.  Use dmmcapture.py to replay or decode it.
+#===========================================================================================
+CAPTURE_MAGIC = b"DMMCAP1\n"
+CAPTURE_RECORD = struct.Struct("<dBH")
+CAPTURE_RECEIVED = 0
+CAPTURE_SENT = 1
+CaptureFile = None
+CaptureLock = threading.Lock()
+
+def StartCapture(FileName):
+    global CaptureFile
+    StopCapture()
+    File = open(FileName, "ab")
+    if File.tell() == 0: File.write(CAPTURE_MAGIC) # New file, else append to it.
+    CaptureFile = File
+
+def StopCapture():
+    global CaptureFile
+    with CaptureLock:
+        if CaptureFile: CaptureFile.close()
+        CaptureFile = None
+
+def CaptureChunk(Direction, data):
+    now = time.monotonic()
+    with CaptureLock:
+        if not CaptureFile: return
+        for a in range(0, len(data), 0xffff):
+            Chunk = data[a:a+0xffff]
+            CaptureFile.write(CAPTURE_RECORD.pack(now, Direction, len(Chunk)) + Chunk)
+
+#===========================================================================================
+# Decode the signed value bytes of a frame, MSB first.
+#===========================================================================================
+def FrameValue(Frame):
+    Value = Frame[2] & 0x7f
+    if Value >= 64: Value -= 128
+    for B in Frame[3:-1]: Value = Value << 7 | (B & 0x7f)
+    return Value
+
+#===========================================================================================
+# Check a frame for format and checksum errors and decode it.
+# Returns (DeviceId, ReplyId, Value) or None if the frame is bad.  Doesn't print or
+# count anything, DecodeCmd does that, so dmmasync.py can use it too.
+#===========================================================================================
+SingleByteReplies = [0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,  0x19, 0x1a]
+def DecodeFrame(Frame):
+    # Check MSBs in all subsequent bytes is set.
+    for a in range (1,len(Frame)):
+        if not Frame[a] & 0x80: return None
+
+    # Check the checksum
+    checksum = 0
+    for a in range (0,len(Frame)-1):
+        checksum += Frame[a]
+
+    if checksum & 0x7f != Frame[-1] &0x7f: return None
+
+    ReplyId = Frame[1] & 0x1f
+    Value = FrameValue(Frame)
+
+    if ReplyId in SingleByteReplies:
+        # Control parameters are only in range 1-127, so treat as unsigned byte.
+        Value = Value & 127
+
+    return Frame[0], ReplyId, Value
+
+# What's wrong with a frame DecodeFrame wouldn't decode, "format" or "checksum"
+def FrameError(Frame):
+    for a in range (1,len(Frame)):
+        if not Frame[a] & 0x80: return "format"
+    return "checksum"
 
 #===========================================================================================
 # Decode a command or reply from serial.
 # Not doing anything with the reply except print its contents.
 #===========================================================================================
-SingleByteReplies = [0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,  0x19, 0x1a]
 def DecodeCmd(Command):
     global RecvReplyIds, ShowSerialBytes
 
     if ShowSerialBytes: print("Decoding: ",Command)
 
-    # Check MSBs in all subsequent bytes is set.
-    for a in range (1,len(Command)):
-        if not Command[a] & 0x80:
+    Decoded = DecodeFrame(Command)
+    if not Decoded:
+        global ChecksumErrors, FormatErrors
+        if FrameError(Command) == "format":
             print("Command format error:", Command)
-            return
-
-    # Check the checksum
-    checksum = 0
-    for a in range (0,len(Command)-1):
-        checksum += Command[a]
+            FormatErrors += 1
+        else:
+            print("Checksum error!")
+            ChecksumErrors += 1
+        return
+    DeviceId, ReplyId, Value = Decoded
 
-    if checksum & 0x7f != Command[-1] &0x7f:
-        print("Checksum error!")
-        return;
+    global EchoesSeen
+    if DeviceId == 0x7f: EchoesSeen += 1
 
-    DeviceId = Command[0]
     if DeviceId == 0x7f and not ShowEchoReplies:
         # If devicd ID has not been set yet (still zero), it will echo everything
         # you send to it.  Once its programmed to nonzero value, it will echo
@@ -132,7 +519,6 @@ def DecodeCmd(Command):
         # the reply to its own ID.
         return
 
-    ReplyId = Command[1] & 0x1f
     if ShowReplies:
         if DeviceId == 0x7f:
             ReplyString = SendCommandLookup[ReplyId]
@@ -141,15 +527,6 @@ def DecodeCmd(Command):
             ReplyString = RecvReplyIds[ReplyId]
             print("     Reply: ",end="")
 
-    # Decode the value bytes
-    Value = Command[2] & 0x7f
-    if Value >= 64: Value -= 128
-    for B in Command[3:-1]: Value = Value << 7 | (B & 0x7f)
-
-    if ReplyId in SingleByteReplies:
-        # Control parameters are only in range 1-127, so treat as unsigned byte.
-        Value = Value & 127
-
     if ShowReplies: print("%s(%02x) Value=%d"%(ReplyString, ReplyId,Value))
 
     global ReplyValues, ReplysDecoded
@@ -158,88 +535,804 @@ def DecodeCmd(Command):
         ReplysDecoded += 1
 
         ReplyValues[ReplyId] = Value
+        ReplyCounts[ReplyId] += 1
+        if DeviceId in Drives:
+            Drives[DeviceId].ReplyValues[ReplyId] = Value
+            Drives[DeviceId].ReplyCounts[ReplyId] += 1
+        ResolvePendingRead(DeviceId, ReplyId, Value, len(Command))
         if SaveDecoded: DecodedQueue.append((DeviceId, ReplyId, Value))
+        for Listener in ReplyListeners: Listener(DeviceId, ReplyId, Value)
 
 #===========================================================================================
-# Process accumulated serial bytes and decode them.
+# Split a stream of serial bytes into frames.
+# A frame starts with a byte that has bit 7 clear (the device ID), all the following
+# bytes have bit 7 set.  So after garbage or a broken frame, the next byte with bit 7
+# clear is always the start of a new frame.
+# Bytes can be fed in any size chunks, each byte is only looked at once.
 #===========================================================================================
-BytesGot = bytes([])
+class FrameParser:
+    def __init__(self, OnFrame):
+        self.OnFrame = OnFrame   # Called with each complete frame
+        self.Frame = bytearray()
+        self.FrameLen = 0        # Length of frame being collected, 0 until 2nd byte seen
+        self.BytesDiscarded = 0  # Bytes that were not part of a complete frame
+        self.FramesCut = 0       # Frames cut short by the start of another frame
+
+    def Feed(self, data):
+        Frame = self.Frame
+        for b in data:
+            if not b & 0x80:
+                if Frame: # Previous frame never completed.
+                    self.BytesDiscarded += len(Frame)
+                    self.FramesCut += 1
+                    del Frame[:]
+                Frame.append(b)
+                self.FrameLen = 0
+            elif not Frame:
+                self.BytesDiscarded += 1 # Not inside a frame, skip till next frame start.
+            else:
+                Frame.append(b)
+                if not self.FrameLen:
+                    self.FrameLen = ((b >> 5)&3) + 4
+                elif len(Frame) == self.FrameLen:
+                    self.OnFrame(bytes(Frame))
+                    del Frame[:]
+
+#===========================================================================================
+# Process serial bytes as they arrive and decode them.
+#===========================================================================================
+Parser = FrameParser(DecodeCmd)
 def RecvData(wait=0.02):
-    global BytesGot
+    if ReaderThread:
+        # Reader thread is already decoding everything as it arrives.
+        # Just give any replies that are on their way time to get here.
+        if wait: time.sleep(wait)
+        return
+
     if wait == 0: # Just get what we got, don't want for more data to arrive.
-        data = ser.read(ser.in_waiting)
-        if BytesGot:
-            BytesGot += data
-        else:
-            BytesGot = data
+        FeedParser(ser.read(ser.in_waiting))
     else:
         start_time = time.time()
-        # Wait 20 ms for any reply that is on its way.
-        while time.time() - start_time < 0.02:
+        # Wait (20 ms by default) for any reply that is on its way.
+        while time.time() - start_time < wait:
             if ser.in_waiting > 0: # Read available bytes
-                data = ser.read(ser.in_waiting)
-                BytesGot += data
+                FeedParser(ser.read(ser.in_waiting))
+            else:
+                time.sleep(0.0005) # Don't burn a whole CPU core polling.
+
+#===========================================================================================
+# Wait until Done() returns true, decoding replies as they come in meanwhile.
+# Returns False if that didn't happen within timeout seconds.
+#===========================================================================================
+def WaitUntil(Done, timeout):
+    end_time = time.time() + timeout
+    with RxCondition:
+        while ReaderThread and not Done():
+            wait = end_time - time.time()
+            if wait <= 0: return False
+            RxCondition.wait(wait)
+    # No reader thread (or it stopped meanwhile), read the port here.
+    while not Done():
+        if ser.in_waiting > 0:
+            FeedParser(ser.read(ser.in_waiting))
+        elif time.time() > end_time:
+            return False
+        else:
+            time.sleep(0.0005)
+    return True
 
-    ProcessedTo = 0
-    for a in range (0, len(BytesGot)-1):
-        if BytesGot[a] & 0x80 == 0:
-            ResLen = ((BytesGot[a+1] >> 5)&3) + 4
-            #print("len ",ResLen,"have:",len(BytesGot)-a)
-            if len(BytesGot) >= a+ResLen:
-                DecodeCmd(BytesGot[a:a+ResLen]) # Have a complete packet
-                a = a+ResLen
-                ProcessedTo = a+ResLen
+#===========================================================================================
+# Wait for a specific reply instead of waiting a fixed time for whatever comes in.
+# Count is ReplyCounts[ReplyId] from before the request was sent, like this:
+#   Count = dmm.ReplyCounts[0x1e]
+#   dmm.ReqTorqCurrent()
+#   Torque = dmm.WaitForReply(0x1e, Count)
+# Returns the value, or None if the reply didn't arrive within timeout seconds.
+#===========================================================================================
+def WaitForReply(ReplyId, Count, timeout=0.1):
+    if not WaitUntil(lambda: ReplyCounts[ReplyId] > Count, timeout): return None
+    return ReplyValues[ReplyId]
 
-    BytesGot = BytesGot[ProcessedTo:] # Remove bytes just processed.
+#===========================================================================================
+# Requests that are waiting for a reply.
+# SendCommand returns a PendingRead for each command that the controller replies to,
+# so you can have lots of reads in flight and then collect the values:
+#   Pos = dmm.ReqPosRead()
+#   Status = dmm.ReqDriveStatus()
+#   print(Pos.Result(), Status.Result())
+# Requests are kept in the order they went out on the wire, one list per device ID.
+# The controller answers in that order too, so a reply goes to the oldest request for
+# that reply ID, and any older requests that weren't answered got dropped.
+# Pass Track=False for requests nobody collects the reply of (like the ones
+# Sampler sends, it keeps track of those itself).  Otherwise, if the controller
+# drops one of those, the next reply of that ID would get matched to it.
+#===========================================================================================
+Outstanding = {}  # Deque of PendingRead for each device ID, in the order they were sent
+OutstandingLock = threading.Lock()
+ReadTimeout = 0.5 # Requests with no reply after this long are assumed dropped.
 
+class PendingRead:
+    def __init__(self, DeviceId, ReplyId, Command=None):
+        self.DeviceId = DeviceId # 0x7f if any device may answer
+        self.ReplyId = ReplyId
+        self.Command = Command   # Command name, for latency statistics
+        self.QueuedTime = time.monotonic()
+        self.SentTime = None     # time.monotonic() when it was written to the port
+        self.TxTime = 0          # Time the bytes written with it take on the wire, plus
+                                 # the bytes still going out ahead of them
+        self.Done = False
+        self.Dropped = False     # No reply is coming
+        self.Value = None
+
+    # Wait for the reply.  Returns its value, or None if it didn't come in time.
+    def Result(self, timeout=0.1):
+        if not WaitUntil(lambda: self.Done, timeout):
+            self.Cancel()
+        return self.Value
+
+    # Stop waiting for a reply, so a later reply won't get matched to this request.
+    def Cancel(self):
+        with OutstandingLock:
+            Waiting = Outstanding.get(self.DeviceId)
+            if Waiting and self in Waiting:
+                Waiting.remove(self)
+                RetireRead(self)
+
+# No reply coming for this one.  Caller holds OutstandingLock.
+def RetireRead(Pending):
+    global RequestsDropped
+    RequestsDropped += 1
+    Pending.Dropped = True
+    Pending.Done = True
+
+# Called with the requests in a frame just before it's written, under WriteLock,
+# so they get added in the order they go out on the wire.
+def AddOutstanding(Pending, now, TxTime):
+    with OutstandingLock:
+        for Request in Pending:
+            Request.SentTime = now
+            Request.TxTime = TxTime
+            Waiting = Outstanding.setdefault(Request.DeviceId, deque())
+            # Forget old requests that never got a reply.
+            while Waiting and now - Waiting[0].SentTime > ReadTimeout:
+                RetireRead(Waiting.popleft())
+            Waiting.append(Request)
+
+def ResolvePendingRead(DeviceId, ReplyId, Value, ReplyBytes=4):
+    with OutstandingLock:
+        # Requests sent to 0x7f get answered with the drive's own ID.
+        for Id in (DeviceId, 0x7f):
+            Waiting = Outstanding.get(Id)
+            if not Waiting: continue
+            for n in range(0, len(Waiting)):
+                if Waiting[n].ReplyId == ReplyId: break
+            else:
+                continue
+            for k in range(0, n): RetireRead(Waiting.popleft()) # Sent before, never answered.
+            Pending = Waiting.popleft()
+            break
+        else:
+            return # Not a reply to anything we track, eg. a Sampler query.
+    Pending.Value = Value
+    Pending.Done = True
+    if ReplyId in ParamReplyIds: ConfirmParam(DeviceId, ReplyId, Value, Pending.QueuedTime)
+    RecordLatency(Pending, ReplyBytes)
+
+#===========================================================================================
+# Protocol statistics, to tell if slowness is from the controller, the serial
+# line or the python code.  Call PrintStats(), or StartStatsDump() to print
+# them every so often.  GetStats() returns them as a dictionary.
+# Latency of each reply is split up into:
+#   Queue:   SendCommand to written to the port (batches, transmit scheduler)
+#   Wire:    Time the request and reply take on the wire at the baud rate, including
+#            waiting for bytes written before the request
+#   Drive:   The rest of the round trip, the controller (and USB adapter) taking its time
+#   Decode:  Reply bytes read to reply decoded (reading them late doesn't show up
+#            here, that's Drive, so use the reader thread)
+# The histogram is the round trip, written to the port until the reply was read.
+# Only tracked requests (see PendingRead) are timed.  Requests Sampler sends are
+# counted as dropped when it sees they were.
+#===========================================================================================
+BytesIn = 0
+BytesOut = 0
+EchoesSeen = 0
+RequestsDropped = 0 # Requests that never got a reply
+LatencyBuckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5] # seconds
+
+class LatencyHistogram:
+    def __init__(self):
+        self.Count = 0
+        self.Total = 0.0
+        self.Max = 0.0
+        self.Buckets = [0]*(len(LatencyBuckets)+1) # Last one is for longer than 0.5 sec
+        self.Parts = {"Queue":0.0, "Wire":0.0, "Drive":0.0, "Decode":0.0} # Totals
+
+    def Add(self, Seconds, Queue=0, Wire=0, Decode=0):
+        self.Count += 1
+        self.Total += Seconds
+        if Seconds > self.Max: self.Max = Seconds
+        self.Buckets[bisect.bisect_left(LatencyBuckets, Seconds)] += 1
+        self.Parts["Queue"] += Queue
+        self.Parts["Wire"] += min(Wire, Seconds)
+        self.Parts["Drive"] += max(0, Seconds-Wire)
+        self.Parts["Decode"] += Decode
+
+Latency = {} # Request to reply latency, by command name
+
+def CommandName(Command, Value=0):
+    if Command == GENERAL_READ: return "General_Read(%02x)"%(Value)
+    return SendCommandLookup[Command]
+
+def RecordLatency(Pending, ReplyBytes):
+    Hist = Latency.get(Pending.Command)
+    if not Hist: Hist = Latency[Pending.Command] = LatencyHistogram()
+    Hist.Add(RxTime - Pending.SentTime, Pending.SentTime - Pending.QueuedTime,
+             Pending.TxTime + ReplyBytes*TxByteTime, time.monotonic() - RxTime)
+
+def GetStats():
+    Stats = {"BytesIn":BytesIn, "BytesOut":BytesOut, "RepliesDecoded":ReplysDecoded,
+             "ChecksumErrors":ChecksumErrors, "FormatErrors":FormatErrors,
+             "BytesDiscarded":Parser.BytesDiscarded, "FramesCut":Parser.FramesCut,
+             "EchoesSeen":EchoesSeen, "RequestsDropped":RequestsDropped,
+             "ParamSetsSkipped":ParamSetsSkipped, "TxDropped":TxDropped, "Latency":{}}
+    for Command, Hist in Latency.items():
+        Stats["Latency"][Command] = {"Count":Hist.Count, "Mean":Hist.Total/Hist.Count,
+                                     "Max":Hist.Max, "Buckets":list(Hist.Buckets)}
+        for Part, Total in Hist.Parts.items():
+            Stats["Latency"][Command][Part] = Total/Hist.Count # Mean
+    return Stats
+
+def ResetStats():
+    global BytesIn, BytesOut, ReplysDecoded, ChecksumErrors, FormatErrors
+    global EchoesSeen, RequestsDropped, ParamSetsSkipped, TxDropped, Latency
+    BytesIn = BytesOut = ReplysDecoded = ChecksumErrors = FormatErrors = 0
+    EchoesSeen = RequestsDropped = ParamSetsSkipped = TxDropped = 0
+    Parser.BytesDiscarded = Parser.FramesCut = 0
+    Latency = {}
+
+def PrintStats():
+    Stats = GetStats()
+    print("Bytes in:%d out:%d  Replies:%d  Echoes:%d  Dropped requests:%d  Sets skipped:%d  Tx dropped:%d"%(
+          BytesIn, BytesOut, ReplysDecoded, EchoesSeen, RequestsDropped, ParamSetsSkipped, TxDropped))
+    print("Checksum errors:%d  Format errors:%d  Bytes discarded:%d  Frames cut:%d"%(
+          ChecksumErrors, FormatErrors, Parser.BytesDiscarded, Parser.FramesCut))
+    if Stats["Latency"]:
+        print("%-20s %6s %7s %7s %6s %6s %6s %6s  ms: "%("Latency","Count","Mean","Max",
+              "Queue","Wire","Drive","Decode")
+              + " ".join("<%g"%(b*1000) for b in LatencyBuckets) + " >500")
+    for Command, Hist in sorted(Stats["Latency"].items()):
+        print("%-20s %6d %7.2f %7.2f %6.2f %6.2f %6.2f %6.2f  "%(Command, Hist["Count"],
+              Hist["Mean"]*1000, Hist["Max"]*1000, Hist["Queue"]*1000, Hist["Wire"]*1000,
+              Hist["Drive"]*1000, Hist["Decode"]*1000)
+              + " ".join(str(n) for n in Hist["Buckets"]))
+
+def StartStatsDump(Interval=10):
+    def DumpLoop():
+        while True:
+            time.sleep(Interval)
+            PrintStats()
+    threading.Thread(target=DumpLoop, daemon=True).start()
+
+#===========================================================================================
+# Optional background thread that decodes replies as soon as they arrive,
+# and wakes up anyone in WaitForReply.
+#===========================================================================================
+ReaderThread = None
+ReaderRunning = False
+RxCondition = threading.Condition()
+def ReaderLoop():
+    global ReaderThread, ReaderRunning
+    while ReaderRunning:
+        try:
+            data = ser.read(1) # Blocks until something arrives or ser.timeout.
+            if not data: continue
+            data += ser.read(ser.in_waiting)
+        except (serial.SerialException, OSError) as e:
+            # Port unplugged, or dmmserver went away.  Stop, so RecvData and WaitUntil
+            # go back to reading the port themselves and the caller gets the error,
+            # instead of everything quietly timing out.
+            print("Reader thread stopped:", e)
+            with RxCondition:
+                ReaderRunning = False
+                ReaderThread = None
+                RxCondition.notify_all()
+            return
+        with RxCondition:
+            FeedParser(data)
+            RxCondition.notify_all()
+
+def StartReader():
+    global ReaderThread, ReaderRunning
+    if ReaderThread: return
+    ser.timeout = 0.1 # So the thread gets to check if it should stop.
+    ReaderRunning = True
+    ReaderThread = threading.Thread(target=ReaderLoop, daemon=True)
+    ReaderThread.start()
+
+def StopReader():
+    global ReaderThread, ReaderRunning
+    Thread = ReaderThread
+    if not Thread: return
+    ReaderRunning = False
+    Thread.join()
+    ReaderThread = None
+    ser.timeout = None
+
+
+#===========================================================================================
+# Adapt how fast queries are sent to what the controller can take.
+# The controller drops queries if they come too fast (above about 50/s for position
+# reads), although the serial link could carry about 500/s.  The caller detects
+# drops (eg. with a Read_MainGain sent every few queries as a sequence marker, like
+# scope.py does) and reports them with Update().  Rate goes up a bit after every
+# report with no drops and gets cut when there are drops (AIMD, like TCP does).
+#===========================================================================================
+class QueryRateControl:
+    def __init__(self, Rate=50, MinRate=10, MaxRate=500, Increase=2, Decrease=0.75):
+        self.Rate = Rate         # Queries per second to send at now
+        self.MinRate = MinRate
+        self.MaxRate = MaxRate
+        self.Increase = Increase # Queries/s added per report without drops
+        self.Decrease = Decrease # Rate multiplied by this when there were drops
+        self.Sent = 0            # Totals over all reports
+        self.Dropped = 0
+        self.DropFraction = 0    # Recent fraction of queries dropped (running average)
+
+    def Update(self, Sent, Dropped):
+        self.Sent += Sent
+        self.Dropped += Dropped
+        if Sent: self.DropFraction = self.DropFraction*0.9 + Dropped/Sent*0.1
+        if Dropped:
+            self.Rate = max(self.MinRate, self.Rate*self.Decrease)
+        else:
+            self.Rate = min(self.MaxRate, self.Rate+self.Increase)
+
+    def Interval(self): return 1/self.Rate # Seconds between queries
+
+#===========================================================================================
+# Run something every Period seconds.  Deadlines are counted from the start, with
+# time.perf_counter(), so the period doesn't drift by however long each run takes, and
+# holds over hours.  If a run overruns past the next deadline, the missed deadlines are
+# skipped (and counted) rather than run back to back to catch up.
+#   Tick = dmm.PeriodicSchedule(1.0)
+#   while True:
+#       Tick.Wait()   # Decodes replies while waiting
+#       ...
+# With tkinter, call Mark() at the start of the callback instead of Wait(), and
+# reschedule with root.after(Tick.Delay(), callback).
+#===========================================================================================
+class PeriodicSchedule:
+    def __init__(self, Period):
+        self.Period = Period
+        self.Start = time.perf_counter()
+        self.Count = 0       # Deadlines since Start
+        self.Runs = 0
+        self.Missed = 0      # Deadlines skipped because a run took too long
+        self.MaxLate = 0     # Seconds
+        self.LateTotal = 0
+        self.LateSquares = 0
+
+    def Deadline(self): return self.Start + self.Count*self.Period
+
+    # Change the period, from the next deadline on.
+    def SetPeriod(self, Period):
+        if Period == self.Period: return
+        self.Start = self.Deadline()
+        self.Count = 0
+        self.Period = Period
+
+    # Record that the run for the current deadline started now.  Returns how late it was.
+    def Mark(self):
+        Late = time.perf_counter() - self.Deadline()
+        self.Runs += 1
+        self.MaxLate = max(self.MaxLate, Late)
+        self.LateTotal += Late
+        self.LateSquares += Late*Late
+        self.Count += 1
+        if Late > self.Period:
+            Skip = int(Late/self.Period)
+            self.Missed += Skip
+            self.Count += Skip
+        return Late
+
+    def Wait(self):
+        wait = self.Deadline() - time.perf_counter()
+        if wait > 0: RecvData(wait)
+        return self.Mark()
+
+    # Milliseconds until the next deadline, for root.after()
+    def Delay(self):
+        return max(0, math.ceil((self.Deadline() - time.perf_counter())*1000))
+
+    def Stats(self):
+        Mean = self.LateTotal/self.Runs if self.Runs else 0
+        Jitter = math.sqrt(max(0, self.LateSquares/self.Runs - Mean*Mean)) if self.Runs else 0
+        return {"Runs":self.Runs, "Missed":self.Missed, "MeanLate":Mean,
+                "MaxLate":self.MaxLate, "Jitter":Jitter}
+
+    def Summary(self):
+        Stats = self.Stats()
+        return "%d runs, %d missed, late mean %.2f max %.2f ms, jitter %.2f ms"%(Stats["Runs"],
+               Stats["Missed"], Stats["MeanLate"]*1000, Stats["MaxLate"]*1000, Stats["Jitter"]*1000)
+
+
+#===========================================================================================
+# Telemetry sampler.  Keeps reading position (0x1b), speed (0x1d) and/or torque (0x1e),
+# interleaved in the ratios given, and keeps timestamped samples of each.
+#   Sampler = dmm.Sampler({0x1b:2, 0x1e:1}, Rate=50)  # 2 position reads per torque read
+#   Sampler.Start()                                   # Or call Step() from your own loop
+#   for t, Torque in Sampler.Take(0x1e, timeout=0.1): ...
+#
+# The controller drops queries that come too fast, and doesn't say so.  Replies come
+# back in the order the queries were sent though, so a reply also tells which earlier
+# queries were dropped.  That works as long as there are different types of queries in
+# the mix, so a Read_MainGain is sent after every MarkerEvery queries as a sequence
+# marker (what scope.py used to do by hand), in place of a query.  A run of drops of just one type of query
+# (eg. all position reads) can shift the timestamps by one until the next marker.
+# Times are time.perf_counter() when the query was sent (less jitter than when the
+# reply arrived).  Each channel keeps at most MaxSamples not yet taken.
+# Publish, if given, gets every sample as it comes in too, eg. TelemetryWriter.Publish
+# from dmmshm.py to share them with other processes.
+#===========================================================================================
+SAMPLER_MARKER = 0x10 # Reply ID of the Read_MainGain sent as a sequence marker
+
+class Sampler:
+    def __init__(self, Channels={0x1b:1}, Rate=50, MarkerEvery=8, MaxSamples=10000,
+                       RateControl=None, Publish=None, id=-1):
+        self.Rate = Rate
+        self.MarkerEvery = MarkerEvery
+        self.RateControl = RateControl # QueryRateControl to adapt Rate to drops, if any
+        self.Publish = Publish # Called with (ReplyId, time, Value, DeviceId) for each sample
+        self.id = id
+        self.Pattern = SamplerPattern(Channels)
+        self.Index = 0
+        self.Samples = {ReplyId:deque(maxlen=MaxSamples) for ReplyId in Channels}
+        self.Latest = {ReplyId:None for ReplyId in Channels} # Most recent value of each
+        self.Sent = {ReplyId:0 for ReplyId in Channels}
+        self.Dropped = {ReplyId:0 for ReplyId in Channels}
+        self.Outstanding = deque() # (Reply ID, time sent) of queries not answered yet
+        self.SinceMarker = 0       # Queries since the last marker sent
+        self.MarkerSent = 0        # Queries and drops since the last marker answered,
+        self.MarkerDropped = 0     # for RateControl
+        self.Lock = threading.Lock()
+        self.Thread = None
+        self.Running = False
+        self.Schedule = None # PeriodicSchedule of the thread, for its timing stats
+        ReplyListeners.append(self.OnReply)
+
+    # Stop listening for replies, for when it's not needed any more.
+    def Close(self):
+        self.Stop()
+        if self.OnReply in ReplyListeners: ReplyListeners.remove(self.OnReply)
+
+    # Send the next query.  Called Rate times a second by Start(), or by the caller.
+    def Step(self):
+        now = time.perf_counter()
+        with self.Lock:
+            # Anything that's been waiting longer than a reply could take got dropped.
+            while self.Outstanding and self.Outstanding[0][1] < now - ReadTimeout:
+                self.Drop(self.Outstanding.popleft()[0])
+            if self.SinceMarker >= self.MarkerEvery:
+                # Marker takes the place of a query, sending it right after one
+                # makes the controller more likely to drop it.
+                ReplyId = SAMPLER_MARKER
+                self.SinceMarker = 0
+            else:
+                ReplyId = self.Pattern[self.Index]
+                self.Index = (self.Index+1) % len(self.Pattern)
+                self.Sent[ReplyId] += 1
+                self.MarkerSent += 1
+                self.SinceMarker += 1
+            self.Outstanding.append((ReplyId, now))
+        if ReplyId == SAMPLER_MARKER:
+            SendCommand(0x18, 0, self.id, Track=False)
+        else:
+            SendCommand(GENERAL_READ, ReplyId, self.id, Track=False)
+
+    def Drop(self, ReplyId):
+        global RequestsDropped
+        RequestsDropped += 1
+        if ReplyId == SAMPLER_MARKER:
+            self.MarkerDone()
+        else:
+            self.Dropped[ReplyId] += 1
+            self.MarkerDropped += 1
+
+    # Marker answered or dropped, tell RateControl how the queries before it went.
+    def MarkerDone(self):
+        if self.RateControl:
+            self.RateControl.Update(self.MarkerSent, self.MarkerDropped)
+            self.Rate = self.RateControl.Rate
+        self.MarkerSent = self.MarkerDropped = 0
+
+    # Called for every reply decoded, in whatever thread is decoding.
+    def OnReply(self, DeviceId, ReplyId, Value):
+        if ReplyId != SAMPLER_MARKER and ReplyId not in self.Samples: return
+        if self.id not in (-1, 0x7f) and DeviceId != self.id: return
+        with self.Lock:
+            for k in range(0, len(self.Outstanding)):
+                if self.Outstanding[k][0] == ReplyId: break
+            else:
+                return # Not a reply to one of our queries.
+            for n in range(0, k): self.Drop(self.Outstanding.popleft()[0])
+            t = self.Outstanding.popleft()[1]
+
+            if ReplyId == SAMPLER_MARKER:
+                self.MarkerDone()
+                return
+            self.Samples[ReplyId].append((t, Value))
+            self.Latest[ReplyId] = Value
+            if self.Publish: self.Publish(ReplyId, t, Value, DeviceId)
+
+    # Return (time, value) samples of a channel that weren't taken yet, oldest first.
+    # Waits up to timeout seconds for one if there aren't any.
+    def Take(self, ReplyId, timeout=0):
+        Samples = self.Samples[ReplyId]
+        if not Samples and timeout: WaitUntil(lambda: Samples, timeout)
+        Taken = []
+        while Samples: Taken.append(Samples.popleft())
+        return Taken
+
+    #---------------------------------------------------------------------------
+    # Sample in a thread of its own.
+    #---------------------------------------------------------------------------
+    def Start(self):
+        if self.Thread: return
+        StartReader() # Replies need decoding while this thread sleeps.
+        self.Running = True
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    def Stop(self):
+        if not self.Thread: return
+        self.Running = False
+        self.Thread.join()
+        self.Thread = None
+
+    def Run(self):
+        self.Schedule = PeriodicSchedule(1/self.Rate)
+        while self.Running:
+            self.Schedule.Wait()
+            self.Step()
+            self.Schedule.SetPeriod(1/self.Rate)
+
+    def Summary(self):
+        return "  ".join("%s: %d sent %d dropped"%(RecvReplyIds[ReplyId], self.Sent[ReplyId],
+                         self.Dropped[ReplyId]) for ReplyId in self.Samples)
+
+# Order to send queries in so each channel gets its share, spread out as evenly as
+# possible, eg. {0x1b:2, 0x1e:1} gives [0x1b, 0x1e, 0x1b]
+def SamplerPattern(Channels):
+    Total = sum(Channels.values())
+    if not Total: raise ValueError("Sampler needs at least one channel")
+    Credit = {ReplyId:0 for ReplyId in Channels}
+    Pattern = []
+    for n in range(0, Total):
+        for ReplyId in Channels: Credit[ReplyId] += Channels[ReplyId]
+        ReplyId = max(Credit, key=Credit.get)
+        Credit[ReplyId] -= Total
+        Pattern.append(ReplyId)
+    return Pattern
+
+#===========================================================================================
+# Fixed size ring buffer of floats, in an array('d') allocated up front, so appending
+# doesn't allocate anything and memory use stays the same however long it runs.
+# Index 0 is the oldest value kept, -1 the newest.  Supports len(), indexing and
+# bisect (if the values are in order, like times).  Views() gives the values in a
+# range as memoryviews of the array, no copying.
+#===========================================================================================
+class RingBuffer:
+    def __init__(self, Capacity):
+        self.Capacity = Capacity
+        self.Data = array.array("d", bytes(8*Capacity))
+        self.View = memoryview(self.Data)
+        self.Count = 0 # Values ever appended
+
+    def Append(self, Value):
+        self.Data[self.Count % self.Capacity] = Value
+        self.Count += 1
+
+    def Clear(self):
+        self.Count = 0
+
+    def __len__(self):
+        return min(self.Count, self.Capacity)
+
+    def __getitem__(self, n):
+        Length = min(self.Count, self.Capacity)
+        if n < 0: n += Length
+        if not 0 <= n < Length: raise IndexError("RingBuffer index out of range")
+        return self.Data[(self.Count - Length + n) % self.Capacity]
+
+    # Values from Start to End (like a slice), as one or two memoryviews.
+    def Views(self, Start=0, End=None):
+        Length = min(self.Count, self.Capacity)
+        if End is None or End > Length: End = Length
+        if Start >= End: return []
+        First = (self.Count - Length + Start) % self.Capacity
+        Last = First + End - Start
+        if Last <= self.Capacity: return [self.View[First:Last]]
+        return [self.View[First:], self.View[:Last-self.Capacity]]
+
+#===========================================================================================
+# For setpoints that change faster than the drive can take them, like from a slider
+# being dragged or a jog key held down.  Only the newest value for each (drive,
+# command) is kept, and they go out at most Rate a second, so the motor follows
+# the latest input instead of working thru a backlog of old values.
+#   Jog = dmm.SetpointQueue(50)
+#   Jog.Send("Go_Absolute_Pos", Pos)   # Replaces Pos from before if not sent yet
+# If sending fails (port not open yet, USB adapter unplugged) the error is printed
+# and counted and the value is dropped, and it carries on with the next one.
+#===========================================================================================
+class SetpointQueue:
+    def __init__(self, Rate=50):
+        self.Rate = Rate
+        self.Queued = {}   # Value to send for each (device ID, command), oldest first
+        self.Sent = 0
+        self.Replaced = 0  # Values replaced by a newer one before they got sent
+        self.Errors = 0    # Sends that failed
+        self.LastError = None
+        self.Condition = threading.Condition()
+        self.Running = True
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    def Send(self, Command, Value=0, id=-1):
+        if isinstance(Command, str): Command = SendCommandIds[Command]
+        with self.Condition:
+            Key = (id, Command)
+            if Key in self.Queued: self.Replaced += 1
+            self.Queued[Key] = Value # Keeps its place in line if it was already queued.
+            self.Condition.notify()
+
+    # Send what's still queued, then stop.
+    def Close(self):
+        with self.Condition:
+            self.Running = False
+            self.Condition.notify()
+        self.Thread.join()
+
+    def Run(self):
+        NextSend = 0
+        while True:
+            with self.Condition:
+                while self.Running and not self.Queued: self.Condition.wait()
+                if not self.Queued: return
+                wait = NextSend - time.monotonic()
+                if wait > 0:
+                    self.Condition.wait(wait)
+                    continue
+                Key = next(iter(self.Queued))
+                Value = self.Queued.pop(Key)
+            try:
+                SendCommand(Key[1], Value, Key[0])
+                self.Sent += 1
+                self.LastError = None
+            except Exception as e:
+                # Only print the first of a run of the same error.
+                if str(e) != self.LastError: print("SetpointQueue: send failed:", e)
+                self.LastError = str(e)
+                self.Errors += 1
+            NextSend = time.monotonic() + 1/self.Rate
 
 #===========================================================================================
 # Request device ID and wait for a reply.
 # Used to verify that a controller is connected to the opened serial port.
+# Returns None if there was no reply.
 #===========================================================================================
 def GetDeviceId():
-    ReplyValues[0x16] = 1000000000 # Invlid return value.
-    SendCommand("Read_Drive_ID")
-    RecvData()
-    if ReplyValues[0x16] == 1000000000: RecvData() # Wait again in case it took longer
-    id = ReplyValues[0x16]
-    return id
+    return SendCommand("Read_Drive_ID").Result(0.04)
 
 
 #===========================================================================================
-# Scan thru COM9 to COM1 (descending) to find the first port that gets a reply from
-# an attached DMM controller
+# Find the serial port an attached DMM controller is on.
+# If dmmserver.py is running, the drive is reached thru it.  Otherwise the port,
+# baud and ID found last time are kept in FindCacheFile and tried first, so
+# normally this is just one round trip.  If that doesn't answer, all candidate
+# ports get probed at the same time, one thread per port, each trying the bauds
+# in FindBauds in turn (a port can only be open at one baud at a time).
 #===========================================================================================
+FindBauds = (38400, 19200, 57600, 115200, 9600)
+FindCacheFile = os.path.join(os.path.expanduser("~"), ".dmmlib_port")
+
+def CandidatePorts():
+    if sys.platform == "win32":
+        return ["COM"+str(x) for x in range(9,1,-1)]
+    Ports = ["/dev/ttyS"+str(x) for x in range(0,5)]
+    Ports += sorted(glob.glob("/dev/ttyUSB*")) + sorted(glob.glob("/dev/ttyACM*"))
+    return [Port for Port in Ports if os.path.exists(Port)]
+
+# Send Read_Drive_ID on a port of our own and wait for the reply.
+# Doesn't go thru DecodeCmd, so probing the wrong port or baud doesn't print errors
+# or count them in the stats.  Returns the drive ID or None.
+def ProbePort(port, baud, timeout=0.04):
+    try:
+        Port = OpenPort(port, baud, timeout=0.005)
+    except (serial.SerialException, OSError, ValueError):
+        return None # Port doesn't exist, is in use, or can't do that baud.
+    Replies = []
+    def OnFrame(Frame):
+        checksum = sum(Frame[:-1])
+        if checksum & 0x7f == Frame[-1] & 0x7f and Frame[1] & 0x1f == 0x16 and Frame[0] != 0x7f:
+            Replies.append(FrameValue(Frame) & 0x7f)
+    Probe = FrameParser(OnFrame)
+    try:
+        Port.reset_input_buffer()
+        Port.write(MakeFrame(0x7f, SendCommandIds["Read_Drive_ID"]))
+        Deadline = time.monotonic() + timeout
+        while not Replies and time.monotonic() < Deadline:
+            Probe.Feed(Port.read(max(1, Port.in_waiting)))
+    except (serial.SerialException, OSError):
+        pass
+    finally:
+        Port.close()
+    return Replies[0] if Replies else None
+
+def LoadFindCache():
+    try:
+        with open(FindCacheFile) as File:
+            port, baud, id = File.read().split()
+        return port, int(baud), int(id)
+    except (OSError, ValueError):
+        return None
+
+def SaveFindCache(port, baud, id):
+    try:
+        with open(FindCacheFile, "w") as File:
+            File.write("%s %d %d\n"%(port, baud, id))
+    except OSError:
+        pass
+
 def FindController():
     global ser
-    if sys.platform == "win32":
-        scan_range = range(9,1,-1)
-        prefix = "COM"
-    else:
-        scan_range = range(0,5)
-        prefix = "/dev/ttyS"
+    Found = None
+    if IsServerSocket(ServerSocket):
+        print("Trying dmmserver:",ServerSocket)
+        id = ProbePort(ServerSocket, 0)
+        if id is not None:
+            OpenSerial(ServerSocket)
+            print("Controller present")
+            return ServerSocket, id
 
-    for x in scan_range:
-        port = prefix+str(x)
-        try:
-            OpenSerial(port)
-        except:
-            # Port doesn't exist
-            continue
+    Cached = LoadFindCache()
+    if Cached:
+        port, baud, id = Cached
         print("Trying port:",port)
+        id = ProbePort(port, baud)
+        if id is not None: Found = port, baud, id
 
-        id = GetDeviceId()
-        if id == 1000000000:
-            # No reply from DMM controller on this serial port.
-            print("No reply from controller")
-            ser.close()
-        else:
-            ID = id
-            # Leave serial port open.
-            print("Controller present")
-            return port, id
-    ser = False
-    return False
+    if not Found:
+        Ports = CandidatePorts()
+        print("Trying ports:"," ".join(Ports))
+        Lock = threading.Lock()
+        Done = threading.Event()
+        Results = []
+        def Probe(port):
+            for baud in FindBauds:
+                if Done.is_set(): return
+                id = ProbePort(port, baud)
+                if id is not None:
+                    with Lock: Results.append((port, baud, id))
+                    Done.set()
+                    return
+        Threads = [threading.Thread(target=Probe, args=(port,), daemon=True) for port in Ports]
+        for Thread in Threads: Thread.start()
+        for Thread in Threads: Thread.join()
+        if Results:
+            # Same order as the port list if more than one answered.
+            Results.sort(key=lambda r: Ports.index(r[0]))
+            Found = Results[0]
+
+    if not Found:
+        print("No reply from controller")
+        ser = False
+        return False
+
+    port, baud, id = Found
+    OpenSerial(port, 0x7f, baud) # Leave serial port open.
+    SaveFindCache(port, baud, id)
+    print("Controller present")
+    return port, id
 
 #===========================================================================================
 # Misc commands
@@ -251,18 +1344,121 @@ def DriveReset():  SendCommand(GENERAL_READ, 0x1c) # reset motor drive to clear
 
 # Request read of pos, torque or speed.
 # Return values will be stored in ReplyValues[n] at 0x1b, 0x1d and 0x1e
-# after calling RecvData()
-def ReqDriveStatus(): SendCommand(0x09) # Status will be at 0x19
-def ReqPosRead():     SendCommand(GENERAL_READ, 0x1b) # Position, at [0x1b]
-def ReqTorqCurrent(): SendCommand(GENERAL_READ, 0x1e) # Torque current, at [0x1d]
-def ReqMotorSpeed():  SendCommand(GENERAL_READ, 0x1d) # Read motor speed, at [0x1e]
+# after calling RecvData(), or use the returned PendingRead to wait for it.
+# Pass Track=False if you're not going to use the PendingRead.
+def ReqDriveStatus(Track=True): return SendCommand(0x09, 0, -1, Track) # Status will be at 0x19
+def ReqPosRead(Track=True):     return SendCommand(GENERAL_READ, 0x1b, -1, Track) # Position, at [0x1b]
+def ReqTorqCurrent(Track=True): return SendCommand(GENERAL_READ, 0x1e, -1, Track) # Torque current, at [0x1e]
+def ReqMotorSpeed(Track=True):  return SendCommand(GENERAL_READ, 0x1d, -1, Track) # Read motor speed, at [0x1d]
+
+#===========================================================================================
+# Talk to the drive thru dmmserver.py instead of opening the serial port directly.
+# Has the few parts of the pyserial interface dmmlib uses, so it can stand in for "ser".
+# The server passes whole command frames on to the drive, and sends the replies back
+# to the program that asked.  Connect to ServerMonitorSocket instead to get every
+# frame that comes back from the drive.
+#===========================================================================================
+ServerSocket = "/tmp/dmmserver.sock"
+ServerMonitorSocket = "/tmp/dmmserver-all.sock"
+
+def IsServerSocket(port):
+    try:
+        return stat.S_ISSOCK(os.stat(port).st_mode)
+    except (OSError, TypeError):
+        return False
+
+class ServerPort:
+    def __init__(self, Path=ServerSocket, timeout=None):
+        self.port = Path
+        self.timeout = timeout
+        self.Buffer = bytearray()
+        self.Sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.Sock.connect(Path)
+
+    def Fill(self, timeout):
+        r,w,x = select.select([self.Sock],[],[],timeout)
+        if not r: return
+        data = self.Sock.recv(4096)
+        if not data: raise serial.SerialException("dmmserver closed the connection")
+        self.Buffer += data
+
+    @property
+    def in_waiting(self):
+        self.Fill(0)
+        return len(self.Buffer)
+
+    def read(self, size=1):
+        Deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(self.Buffer) < size:
+            wait = None if Deadline is None else Deadline - time.monotonic()
+            if wait is not None and wait <= 0: break
+            self.Fill(wait)
+        data = bytes(self.Buffer[:size])
+        del self.Buffer[:size]
+        return data
+
+    def write(self, data):
+        self.Sock.sendall(data)
+
+    def reset_input_buffer(self):
+        self.Fill(0)
+        self.Buffer.clear()
+
+    def close(self):
+        self.Sock.close()
+
+# Open a serial port, or a connection to dmmserver.py if port is its socket.
+def OpenPort(port, baud=38400, timeout=None):
+    if IsServerSocket(port): return ServerPort(port, timeout)
+    # Exclusive, so a second program (or dmmserver) can't open the port and
+    # take some of the replies.
+    return serial.Serial(port, baud, timeout=timeout, exclusive=True)
 
 # requires "pip3 instll pyserial" for serial to be enabled.
-def OpenSerial(port="COM7",ID=0x7f):
-    global ser, Controller_ID, ShowSerialBytes, ShowEchoReplies, ShowReplies
+def OpenSerial(port="COM7",ID=0x7f,baud=38400):
+    global ser, Controller_ID, ShowSerialBytes, ShowEchoReplies, ShowReplies, TxByteTime
     Controller_ID = ID
+    if baud: TxByteTime = 10/baud
     ShowSerialBytes = False
     ShowEchoReplies = True
     ShowReplies = True
 
-    ser = serial.Serial(port, 38400)
+    ser = OpenPort(port, baud)
+
+#===========================================================================================
+# Per drive state, for several drives chained on the same serial port.
+# Replies get routed to the Drive with the same device ID, so you don't have to
+# switch Controller_ID back and forth, eg:
+#   Left = dmm.Drive(20); Right = dmm.Drive(21)
+#   Left.SendCommand("Go_Absolute_Pos", 1000)
+#   LeftPos, RightPos = dmm.ReadAll([Left, Right], dmm.GENERAL_READ, 0x1b)
+#===========================================================================================
+Drives = {} # Drive objects by device ID
+
+class Drive:
+    def __init__(self, ID):
+        self.ID = ID
+        self.ReplyValues = [1000000000]*32 # Like the global ReplyValues, but only this drive
+        self.ReplyCounts = [0]*32
+        Drives[ID] = self
+
+    def SendCommand(self, Command, Value=0, Track=True): return SendCommand(Command, Value, self.ID, Track)
+
+    def DriveEnable(self):  self.SendCommand(GENERAL_READ, 0x20)
+    def DriveDisable(self): self.SendCommand(GENERAL_READ, 0x21)
+    def DriveReset(self):   self.SendCommand(GENERAL_READ, 0x1c)
+    def ReadParam(self, Param, Fresh=False): return ReadParam(Param, Fresh, self.ID)
+
+    def ReqDriveStatus(self, Track=True): return self.SendCommand(0x09, 0, Track)
+    def ReqPosRead(self, Track=True):     return self.SendCommand(GENERAL_READ, 0x1b, Track)
+    def ReqTorqCurrent(self, Track=True): return self.SendCommand(GENERAL_READ, 0x1e, Track)
+    def ReqMotorSpeed(self, Track=True):  return self.SendCommand(GENERAL_READ, 0x1d, Track)
+
+#===========================================================================================
+# Send the same read to several drives and return their replies (None if no reply).
+# All the requests go out before waiting for any reply, so reading N drives takes
+# about one round trip instead of N.
+#===========================================================================================
+def ReadAll(DriveList, Command, Value=0, timeout=0.1):
+    Pending = [d.SendCommand(Command, Value) for d in DriveList]
+    return [p.Result(timeout) for p in Pending]
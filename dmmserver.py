@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# Drive server: keeps the serial port to the DMM controller open, and lets
+# several programs use the drive at the same time thru a Unix socket.
+#
+# Programs connect with dmmlib.OpenSerial(dmmlib.ServerSocket), or just run as
+# usual -- FindController and dmm.py use the server if it's running, which also
+# saves opening and probing the serial port every time.
+#
+# Commands from each program are passed on to the drive a whole frame at a time,
+# so commands from different programs never get mixed up on the wire.  Replies
+# from the drive go back to the program that asked for them.  The drive answers
+# in the order the requests went out, so the server keeps a list of who asked,
+# in that order, for each device ID (like dmmlib does with PendingRead).  Echoes
+# go to every program.
+#
+# Programs that connect to the monitor socket (dmmlib.ServerMonitorSocket) get
+# every frame that comes back from the drive, whoever asked for it, eg:
+#   python3 dmm.py /tmp/dmmserver-all.sock mon
+#
+# Usage:
+#   python3 dmmserver.py                  Find the controller, serve on /tmp/dmmserver.sock
+#   python3 dmmserver.py --port /dev/ttyUSB0 --baud 38400
+#
+# Only works on systems with Unix domain sockets (Linux, Mac)
+import os, sys, time, socket, selectors, threading, argparse
+from collections import deque
+import dmmlib as dmm
+
+# Remove a socket left over from a previous run.  If a server is still answering on
+# it, leave it alone and raise FileExistsError -- two servers reading the same serial
+# port would each get some of the replies.
+def RemoveStaleSocket(Path):
+    if not dmm.IsServerSocket(Path): return
+    Probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        Probe.connect(Path)
+    except ConnectionRefusedError:
+        os.remove(Path) # Nothing listening on it anymore.
+        return
+    finally:
+        Probe.close()
+    raise FileExistsError("dmmserver already running on "+Path)
+
+class DriveServer:
+    def __init__(self, Path=dmm.ServerSocket, MonitorPath=dmm.ServerMonitorSocket):
+        self.Path = Path
+        self.MonitorPath = MonitorPath
+        self.Clients = {}     # Frame parser for the commands from each connected socket
+        self.Monitors = set() # Clients that get every frame from the drive
+        self.Outstanding = {} # Deque of (reply ID, socket, time sent) for each device ID,
+                              # in the order the requests went out
+        self.Lock = threading.Lock() # Clients is used by the serial reader thread too
+        self.Selector = selectors.DefaultSelector()
+
+        self.Listen = self.ListenOn(Path)
+        self.MonitorListen = self.ListenOn(MonitorPath)
+
+        # Replies from the drive still go thru DecodeCmd so stats and captures work.
+        dmm.Parser = dmm.FrameParser(self.DriveFrame)
+        dmm.StartReader()
+
+    def ListenOn(self, Path):
+        RemoveStaleSocket(Path)
+        Listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        Listen.bind(Path)
+        Listen.listen()
+        self.Selector.register(Listen, selectors.EVENT_READ)
+        return Listen
+
+    def Close(self):
+        with self.Lock:
+            for Sock in self.Clients: Sock.close()
+            self.Clients = {}
+            self.Monitors = set()
+        for Listen, Path in ((self.Listen, self.Path), (self.MonitorListen, self.MonitorPath)):
+            Listen.close()
+            if dmm.IsServerSocket(Path): os.remove(Path)
+
+    #---------------------------------------------------------------------------
+    # Command from a client, note who gets the reply and pass it on to the drive.
+    # Caller holds Lock, so the requests are noted in the order they go out.
+    #---------------------------------------------------------------------------
+    def ClientFrame(self, Sock, Frame):
+        if sum(Frame[:-1]) & 0x7f == Frame[-1] & 0x7f: # Drive ignores it otherwise
+            ReplyId = dmm.CommandReplyId(Frame[1] & 0x1f, dmm.FrameValue(Frame))
+            if ReplyId is not None:
+                now = time.monotonic()
+                Waiting = self.Outstanding.setdefault(Frame[0], deque())
+                # Forget requests that never got a reply.
+                while Waiting and now - Waiting[0][2] > dmm.ReadTimeout: Waiting.popleft()
+                Waiting.append((ReplyId, Sock, now))
+        dmm.WriteSerial(Frame)
+
+    # Client that asked for this reply, or None.  Caller holds Lock.
+    def Asker(self, DeviceId, ReplyId):
+        # Requests sent to 0x7f get answered with the drive's own ID.
+        for Id in (DeviceId, 0x7f):
+            Waiting = self.Outstanding.get(Id)
+            if not Waiting: continue
+            for n in range(0, len(Waiting)):
+                if Waiting[n][0] == ReplyId: break
+            else:
+                continue
+            for k in range(0, n): Waiting.popleft() # Sent before, dropped by the drive.
+            return Waiting.popleft()[1]
+        return None
+
+    #---------------------------------------------------------------------------
+    # Frame from the drive, pass it on to whoever asked, and the monitors.
+    # Runs in the reader thread.
+    #---------------------------------------------------------------------------
+    def DriveFrame(self, Frame):
+        dmm.DecodeCmd(Frame)
+        with self.Lock:
+            if Frame[0] == 0x7f:
+                SendTo = list(self.Clients) # Echo
+            else:
+                Asker = self.Asker(Frame[0], Frame[1] & 0x1f)
+                SendTo = [Sock for Sock in self.Clients if Sock is Asker or Sock in self.Monitors]
+            for Sock in SendTo:
+                try:
+                    Sock.sendall(Frame)
+                except OSError:
+                    # Gone, or not reading (send timed out), drop it.
+                    self.Drop(Sock)
+
+    def Drop(self, Sock):
+        # Caller holds Lock.  Its requests stay in Outstanding to keep the order.
+        if Sock not in self.Clients: return
+        del self.Clients[Sock]
+        self.Monitors.discard(Sock)
+        self.Selector.unregister(Sock)
+        Sock.close()
+        print("Client disconnected,", len(self.Clients), "connected")
+
+    #---------------------------------------------------------------------------
+    # Main loop, accept connections and pass commands on to the drive.
+    #---------------------------------------------------------------------------
+    def Run(self):
+        while True:
+            for Key, Events in self.Selector.select():
+                Sock = Key.fileobj
+                if Sock is self.Listen or Sock is self.MonitorListen:
+                    Listen = Sock
+                    Sock, Address = Listen.accept()
+                    Sock.settimeout(0.5) # So a stuck client can't hold up the reader thread for long.
+                    with self.Lock:
+                        self.Clients[Sock] = dmm.FrameParser(
+                                lambda Frame, Sock=Sock: self.ClientFrame(Sock, Frame))
+                        if Listen is self.MonitorListen: self.Monitors.add(Sock)
+                        self.Selector.register(Sock, selectors.EVENT_READ)
+                        print("Client connected,", len(self.Clients), "connected")
+                    continue
+
+                try:
+                    data = Sock.recv(4096)
+                except OSError:
+                    data = b""
+                with self.Lock:
+                    if not data:
+                        self.Drop(Sock)
+                    elif Sock in self.Clients:
+                        self.Clients[Sock].Feed(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share a DMM controller between programs")
+    parser.add_argument("--port", help="Serial port, default is to look for the controller")
+    parser.add_argument("--baud", type=int, default=38400, help="Baud rate if --port is given")
+    parser.add_argument("--socket", default=dmm.ServerSocket, help="Unix socket to listen on")
+    parser.add_argument("--monitor-socket", default=dmm.ServerMonitorSocket,
+                        help="Unix socket for clients that get every frame from the drive")
+    args = parser.parse_args()
+
+    try:
+        # Also so FindController doesn't find the old server.
+        RemoveStaleSocket(args.socket)
+        RemoveStaleSocket(args.monitor_socket)
+    except FileExistsError as e:
+        print(e)
+        sys.exit(-1)
+    if args.port:
+        try:
+            dmm.OpenSerial(args.port, 0x7f, args.baud)
+        except (dmm.serial.SerialException, OSError) as e:
+            print(e) # Doesn't exist, or another program has it open.
+            sys.exit(-1)
+    elif not dmm.FindController():
+        print("No DMM controller found")
+        sys.exit(-1)
+    dmm.ShowReplies = False
+    dmm.ShowEchoReplies = False
+
+    server = DriveServer(args.socket, args.monitor_socket)
+    print("Serving on", args.socket, "and", args.monitor_socket)
+    try:
+        server.Run()
+    except KeyboardInterrupt:
+        print()
+        server.Close()
+        dmm.PrintStats()
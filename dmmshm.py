@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# Telemetry samples in shared memory, for other processes to look at.
+#
+# The program talking to the drive publishes each sample into a ring buffer in
+# multiprocessing.shared_memory, and any number of other processes (a logger, a
+# plot, some analysis) can read them from there without going near the serial
+# port, and without the samples being copied thru a pipe.
+#
+#   Writer = dmmshm.TelemetryWriter()                   # In the program with the drive
+#   Sampler = dmm.Sampler({0x1b:1}, Publish=Writer.Publish)
+#
+#   Reader = dmmshm.TelemetryReader()                   # In another process
+#   for Seq, t, DeviceId, ReplyId, Value in Reader.Read(): ...
+#
+# One writer, no locks.  Each record has a sequence number, written after the rest
+# of the record, which readers check before and after copying it out.  So a reader
+# that falls more than a ring's worth behind, or reads a slot while it's being
+# rewritten, notices and counts the records as lost instead of returning garbage.
+# Times are time.perf_counter() of the writer when the sample was requested.
+#
+# Usage:
+#   python3 dmmshm.py            Print samples as they get published
+#   python3 dmmshm.py rate       Just print samples/s and lost counts
+import os, sys, time, struct, atexit
+from multiprocessing import shared_memory
+
+DEFAULT_NAME = "dmm_telemetry"
+MAGIC = b"DMMTEL1\0"
+HEADER = struct.Struct("<8sIIQQ")  # Magic, capacity, record size, records written,
+                                   # process ID of the writer
+SEQ_OFFSET = 16                    # Where records written is in the header
+HEADER_SIZE = 32
+RECORD = struct.Struct("<QdqBB6x") # Sequence+1 (0 while being written), time, value,
+                                   # reply ID, device ID
+SEQ = struct.Struct("<Q")
+BODY = struct.Struct("<dqBB")
+Writing = set() # Names of the rings this process is the writer of
+
+class TelemetryWriter:
+    def __init__(self, Name=DEFAULT_NAME, Capacity=65536):
+        Size = HEADER_SIZE + Capacity*RECORD.size
+        try:
+            self.Shm = shared_memory.SharedMemory(Name, create=True, size=Size)
+        except FileExistsError:
+            Old = shared_memory.SharedMemory(Name)
+            try:
+                Live = WriterAlive(Old)
+            finally:
+                Old.close()
+            if Live:
+                Untrack(Old)
+                raise FileExistsError("Telemetry ring %s is in use by another program"%(Name))
+            # Left over from a program that didn't get to clean up.
+            Old.unlink()
+            self.Shm = shared_memory.SharedMemory(Name, create=True, size=Size)
+        self.Buf = self.Shm.buf
+        self.Capacity = Capacity
+        self.Seq = 0
+        HEADER.pack_into(self.Buf, 0, MAGIC, Capacity, RECORD.size, 0, os.getpid())
+        Writing.add(Name)
+        self.Name = Name
+        atexit.register(self.Close)
+
+    def Publish(self, ReplyId, t, Value, DeviceId=0x7f):
+        n = self.Seq
+        Offset = HEADER_SIZE + (n % self.Capacity)*RECORD.size
+        SEQ.pack_into(self.Buf, Offset, 0) # Readers will see it's being written.
+        BODY.pack_into(self.Buf, Offset+8, t, Value, ReplyId, DeviceId)
+        SEQ.pack_into(self.Buf, Offset, n+1)
+        self.Seq = n+1
+        SEQ.pack_into(self.Buf, SEQ_OFFSET, n+1)
+
+    def Close(self):
+        if not self.Shm: return
+        self.Buf = None
+        self.Shm.close()
+        self.Shm.unlink()
+        self.Shm = None
+        Writing.discard(self.Name)
+
+# So the resource tracker doesn't delete shared memory this process only attached to
+# when it exits (it does, before python 3.13), even though its writer still has it.
+def Untrack(Shm):
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(Shm._name, "shared_memory")
+
+# Is something still writing to this existing ring?  Checks whether the process that
+# made it is still there, or if that's not known, whether records are still being added.
+def WriterAlive(Shm, Wait=0.2):
+    if sys.platform == "win32": return True # Windows deletes it when the last user closes it
+    if Shm.size < HEADER.size: return True  # Not ours, leave it alone
+    Magic, Capacity, RecordSize, Written, Pid = HEADER.unpack_from(Shm.buf, 0)
+    if Magic != MAGIC: return True
+    if Pid:
+        try:
+            os.kill(Pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass # Someone else's process.
+        return True
+    time.sleep(Wait)
+    return SEQ.unpack_from(Shm.buf, SEQ_OFFSET)[0] != Written
+
+class TelemetryReader:
+    def __init__(self, Name=DEFAULT_NAME, FromStart=False):
+        try:
+            self.Shm = shared_memory.SharedMemory(Name, track=False)
+        except TypeError:
+            self.Shm = shared_memory.SharedMemory(Name) # Before python 3.13
+            if Name not in Writing: Untrack(self.Shm)
+        Magic, self.Capacity, RecordSize, Written, Pid = HEADER.unpack_from(self.Shm.buf, 0)
+        if Magic != MAGIC or RecordSize != RECORD.size:
+            raise ValueError(Name+" is not a dmmshm telemetry ring")
+        # Start with the oldest record still there, or with the next one written.
+        self.Next = max(0, Written-self.Capacity) if FromStart else Written
+        self.Lost = 0 # Records overwritten before this reader got to them
+
+    # Records published since the last call, as (Seq, time, DeviceId, ReplyId, Value)
+    def Read(self, MaxRecords=None):
+        Buf = self.Shm.buf
+        Written = SEQ.unpack_from(Buf, SEQ_OFFSET)[0]
+        if Written - self.Next > self.Capacity:
+            # Fell too far behind, those records are gone.
+            self.Lost += Written - self.Capacity - self.Next
+            self.Next = Written - self.Capacity
+        if MaxRecords: Written = min(Written, self.Next + MaxRecords)
+
+        Records = []
+        while self.Next < Written:
+            n = self.Next
+            self.Next += 1
+            Offset = HEADER_SIZE + (n % self.Capacity)*RECORD.size
+            Seq, t, Value, ReplyId, DeviceId = RECORD.unpack_from(Buf, Offset)
+            if Seq != n+1 or SEQ.unpack_from(Buf, Offset)[0] != n+1:
+                self.Lost += 1 # Overwritten while we were reading it.
+                continue
+            Records.append((n, t, DeviceId, ReplyId, Value))
+        return Records
+
+    def Close(self):
+        self.Shm.close()
+
+
+if __name__ == "__main__":
+    Names = {0x1b:"Pos", 0x1d:"Speed", 0x1e:"Torque"}
+    try:
+        Reader = TelemetryReader()
+    except FileNotFoundError:
+        print("No telemetry being published (start the scope in ServoTune)")
+        sys.exit(-1)
+
+    RateOnly = "rate" in sys.argv[1:]
+    Count = 0
+    LastReport = time.perf_counter()
+    try:
+        while True:
+            for Seq, t, DeviceId, ReplyId, Value in Reader.Read():
+                Count += 1
+                if not RateOnly:
+                    print("%8d %12.4f %-6s %d"%(Seq, t, Names.get(ReplyId, "%02x"%ReplyId), Value))
+            now = time.perf_counter()
+            if RateOnly and now - LastReport >= 1:
+                print("%5.0f samples/s, %d lost"%(Count/(now-LastReport), Reader.Lost))
+                Count = 0
+                LastReport = now
+            time.sleep(0.02)
+    except KeyboardInterrupt:
+        Reader.Close()
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# Virtual DMM servo controller on a pseudo terminal.
+#
+# Speaks the same serial protocol as the DYN2 controller, so dmmlib, dmm.py and
+# ServoTune can be run and benchmarked on a machine without a drive attached.
+# The motion model is crude -- it's only there so position, speed and torque
+# reads return something that changes.
+#
+# Can also misbehave like the real controller: add reply latency, drop queries
+# that come in too fast (the real one drops position queries above about 50/s),
+# drop queries at random and corrupt reply checksums.
+#
+# Usage:
+#   python3 dmmsim.py --id 20 --max-query-rate 50
+# then point dmm.py at the pty it prints, eg: python3 dmm.py /dev/pts/5 readall
+#
+# Only works on Linux (or other systems with os.openpty)
+import os, time, tty, select, random, threading, argparse
+from collections import deque
+import dmmlib as dmm
+
+class VirtualDrive:
+    def __init__(self, DriveId=20, Latency=0, DropRate=0, MaxQueryRate=0,
+                       CorruptRate=0, Baud=38400, Link=None):
+        self.DriveId = DriveId
+        self.Latency = Latency          # Seconds before a reply starts going out
+        self.DropRate = DropRate        # Fraction of queries dropped at random
+        self.MaxQueryRate = MaxQueryRate# Queries/second above which queries get dropped
+        self.CorruptRate = CorruptRate  # Fraction of replies sent with a bad checksum
+        self.ByteTime = 10/Baud if Baud else 0 # Time to send a byte on the wire
+
+        # Parameters as they would be read back, indexed by reply ID
+        self.Params = {0x10:50, 0x11:10, 0x12:10, 0x13:127, 0x14:80, 0x15:29,
+                       0x17:10, 0x18:4096, 0x1a:0}
+        self.Enabled = True
+        self.Position = 0.0   # In Go_Absolute_Pos units, 16384 per turn
+        self.Target = 0
+        self.ConstSpeed = None# RPM if in constant speed mode
+        self.Speed = 0.0
+        self.LastMove = time.time()
+
+        self.Queries = self.Dropped = self.Corrupted = self.Echoed = 0
+        self.LastQuery = 0
+        self.QueryTokens = 2
+
+        self.Parser = dmm.FrameParser(self.HandleFrame)
+        self.TxQueue = deque()  # (time to send, bytes)
+        self.LineFree = 0       # When the simulated wire is done sending queued bytes
+
+        self.Master, self.Slave = os.openpty()
+        tty.setraw(self.Slave)
+        self.PortName = os.ttyname(self.Slave)
+        self.Link = Link
+        if Link:
+            # So FindController or scripts with a hard coded port can find it
+            if os.path.lexists(Link): os.remove(Link)
+            os.symlink(self.PortName, Link)
+
+        self.Running = True
+        self.Thread = threading.Thread(target=self.Run, daemon=True)
+        self.Thread.start()
+
+    def Close(self):
+        self.Running = False
+        self.Thread.join()
+        if self.Link and os.path.islink(self.Link): os.remove(self.Link)
+        os.close(self.Master)
+        os.close(self.Slave)
+
+    #---------------------------------------------------------------------------
+    # Main loop, read commands from the pty and send replies when they are due.
+    #---------------------------------------------------------------------------
+    def Run(self):
+        while self.Running:
+            timeout = 0.1
+            if self.TxQueue:
+                timeout = max(0, min(timeout, self.TxQueue[0][0]-time.time()))
+            r,w,x = select.select([self.Master],[],[],timeout)
+            if r:
+                try:
+                    data = os.read(self.Master, 1024)
+                except OSError:
+                    data = b""
+                self.Parser.Feed(data)
+
+            now = time.time()
+            while self.TxQueue and self.TxQueue[0][0] <= now:
+                os.write(self.Master, self.TxQueue.popleft()[1])
+
+    def Send(self, Frame):
+        now = time.time()
+        start = max(now + self.Latency, self.LineFree)
+        self.LineFree = start + len(Frame)*self.ByteTime
+        self.TxQueue.append((self.LineFree, Frame))
+
+    def Reply(self, ReplyId, Value):
+        Frame = dmm.MakeFrame(self.DriveId, ReplyId, Value)
+        if self.CorruptRate and random.random() < self.CorruptRate:
+            Frame = Frame[:-1]+bytes([Frame[-1] ^ 0x01])
+            self.Corrupted += 1
+        self.Send(Frame)
+
+    #---------------------------------------------------------------------------
+    # Act on a command frame the way the DYN2 controller does.
+    #---------------------------------------------------------------------------
+    def HandleFrame(self, Frame):
+        checksum = 0
+        for b in Frame[:-1]: checksum += b
+        if checksum & 0x7f != Frame[-1] & 0x7f: return # Real drive ignores it too.
+
+        DeviceId = Frame[0]
+        Mine = DeviceId == 0x7f or DeviceId == self.DriveId
+        if not Mine or self.DriveId == 0:
+            # Not addressed to us (or ID not yet set), pass it back out unchanged.
+            self.Send(Frame)
+            self.Echoed += 1
+        if not Mine: return
+
+        Command = Frame[1] & 0x1f
+        Value = dmm.FrameValue(Frame)
+        self.UpdateMotion()
+
+        if Command in dmm.ReadReplyIds or Command == dmm.GENERAL_READ and Value in (0x1b,0x1d,0x1e):
+            if not self.AcceptQuery(): return
+
+        if Command in dmm.ReadReplyIds:
+            ReplyId = dmm.ReadReplyIds[Command]
+            if ReplyId == 0x16:
+                self.Reply(ReplyId, self.DriveId)
+            elif ReplyId == 0x19:
+                self.Reply(ReplyId, self.Status())
+            else:
+                self.Reply(ReplyId, self.Params[ReplyId])
+        elif Command in dmm.SetParamReplyIds:
+            self.Params[dmm.SetParamReplyIds[Command]] = Value
+        elif Command == dmm.GENERAL_READ:
+            if Value == 0x1b: self.Reply(0x1b, int(self.Position*4)) # 65536 per turn
+            elif Value == 0x1d: self.Reply(0x1d, int(self.Speed))
+            elif Value == 0x1e: self.Reply(0x1e, self.Torque())
+            elif Value == 0x20: self.Enabled = True
+            elif Value == 0x21: self.Enabled = False
+            elif Value == 0x1c: # Drive reset
+                self.Enabled = True
+                self.ConstSpeed = None
+                self.Target = int(self.Position)
+        elif Command == 0x00: # Set_Origin
+            self.Position = self.Target = 0
+        elif Command == 0x01: # Go_Absolute_Pos
+            self.Target = Value
+            self.ConstSpeed = None
+        elif Command == 0x03: # Go_Relative_Pos
+            self.Target += Value
+            self.ConstSpeed = None
+        elif Command == 0x0a: # Turn_ConstSpeed
+            self.ConstSpeed = Value
+        elif Command == 0x05: # Assign_Drive_ID
+            self.DriveId = Value & 0x7f
+        elif Command == 0x07: # Set_Drive_Config
+            self.Params[0x1a] = Value
+
+    def AcceptQuery(self):
+        # Queries above MaxQueryRate get dropped, but a couple in a row are ok.
+        self.Queries += 1
+        now = time.time()
+        if self.MaxQueryRate:
+            self.QueryTokens = min(2, self.QueryTokens + (now-self.LastQuery)*self.MaxQueryRate)
+            self.LastQuery = now
+        if self.MaxQueryRate and self.QueryTokens < 1 \
+                or self.DropRate and random.random() < self.DropRate:
+            self.Dropped += 1
+            return False
+        if self.MaxQueryRate: self.QueryTokens -= 1
+        return True
+
+    #---------------------------------------------------------------------------
+    # Simple motion model: move to target at a speed set by the HighSpeed param.
+    #---------------------------------------------------------------------------
+    def UpdateMotion(self):
+        now = time.time()
+        dt = now - self.LastMove
+        self.LastMove = now
+        OldPos = self.Position
+        if not self.Enabled:
+            self.Speed = 0
+            return
+        if self.ConstSpeed is not None:
+            self.Position += self.ConstSpeed*16384/60*dt
+            self.Target = int(self.Position)
+        else:
+            step = self.Params[0x14]*16384*dt/10
+            error = self.Target - self.Position
+            self.Position += max(-step, min(step, error))
+        self.Speed = (self.Position-OldPos)/16384*60/dt if dt else 0
+
+    def Torque(self):
+        if not self.Enabled: return 0
+        return int(max(-1000, min(1000, (self.Target-self.Position)*self.Params[0x10]/100)))
+
+    def Status(self):
+        status = 0
+        if self.Target != int(self.Position): status |= 1 # Busy
+        if not self.Enabled: status |= 2 # Freewheel
+        return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual DMM servo controller on a pty")
+    parser.add_argument("--id", type=int, default=20, help="Drive ID (0 = echo everything)")
+    parser.add_argument("--latency", type=float, default=0, help="Reply latency, seconds")
+    parser.add_argument("--drop", type=float, default=0, help="Fraction of queries dropped at random")
+    parser.add_argument("--max-query-rate", type=float, default=0, help="Drop queries that come faster than this per second")
+    parser.add_argument("--corrupt", type=float, default=0, help="Fraction of replies with a bad checksum")
+    parser.add_argument("--baud", type=int, default=38400, help="Simulated wire speed, 0 for instant")
+    parser.add_argument("--link", help="Make a symlink to the pty with this name")
+    args = parser.parse_args()
+
+    drive = VirtualDrive(args.id, args.latency, args.drop, args.max_query_rate,
+                         args.corrupt, args.baud, args.link)
+    print("Virtual DMM drive id %d on %s"%(drive.DriveId, args.link or drive.PortName))
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nQueries:",drive.Queries,"Dropped:",drive.Dropped,
+              "Corrupted:",drive.Corrupted,"Echoed:",drive.Echoed)
+        drive.Close()
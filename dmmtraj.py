@@ -0,0 +1,177 @@
+# Trajectory streaming for the DMM servo controller.
+#
+# Instead of a Go_Absolute_Pos to the end point and letting the drive's own
+# HighSpeed/HighAccel limits shape the move, the whole motion is worked out ahead
+# of time as a list of setpoints, Rate a second, and streamed to the drive on a
+# fixed schedule.  So a move comes out the same every run, and speed and
+# acceleration can change within a move without retuning the drive in between.
+#
+#   Move = dmmtraj.Trapezoid(0, 16384, 32768, 100000)        # One turn
+#   Move += dmmtraj.SCurve(16384, 0, 32768, 100000, 1000000) # and back
+#   Result = dmmtraj.Stream(Move)
+#   print("Max tracking error", Result.MaxError)
+#
+# Positions are in Go_Absolute_Pos units (16384 per turn), speeds in units per
+# second, acceleration in units/s^2 and jerk in units/s^3.  Set HighSpeed and
+# HighAccel high enough that the drive doesn't smooth the setpoints further.
+import math
+import dmmlib as dmm
+
+class Trajectory:
+    def __init__(self, Positions, Rate=100):
+        self.Positions = Positions # Setpoint for each 1/Rate seconds, first one at time zero
+        self.Rate = Rate
+
+    def Duration(self):
+        return (len(self.Positions)-1)/self.Rate
+
+    def Times(self):
+        return [n/self.Rate for n in range(0, len(self.Positions))]
+
+    # Moves joined up one after the other.
+    def __add__(self, Other):
+        if Other.Rate != self.Rate: raise ValueError("Trajectories have different rates")
+        return Trajectory(self.Positions + Other.Positions[1:], self.Rate)
+
+#===========================================================================================
+# Sample a position function of time, Rate times a second, ending exactly at End.
+#===========================================================================================
+def Sample(PosFunc, Duration, End, Rate):
+    Count = max(1, math.ceil(Duration*Rate))
+    Positions = [int(round(PosFunc(n/Rate))) for n in range(0, Count)]
+    Positions.append(int(round(End)))
+    return Trajectory(Positions, Rate)
+
+# Position at time t of a trapezoidal speed profile from Start to End, as a function.
+def TrapezoidFunc(Start, End, Speed, Accel):
+    Distance = abs(End-Start)
+    Sign = 1 if End >= Start else -1
+    if Speed*Speed/Accel > Distance:
+        Speed = math.sqrt(Distance*Accel) # Never gets to full speed, triangular profile.
+    AccelTime = Speed/Accel
+    CruiseTime = (Distance - Speed*AccelTime)/Speed if Speed else 0
+    Duration = 2*AccelTime + CruiseTime
+
+    def Pos(t):
+        if t <= 0: return Start
+        if t >= Duration: return End
+        if t < AccelTime:
+            d = Accel*t*t/2
+        elif t < AccelTime + CruiseTime:
+            d = Speed*AccelTime/2 + Speed*(t-AccelTime)
+        else:
+            r = Duration - t
+            d = Distance - Accel*r*r/2
+        return Start + Sign*d
+    return Pos, Duration
+
+#===========================================================================================
+# Move from Start to End at up to Speed, with constant acceleration Accel.
+#===========================================================================================
+def Trapezoid(Start, End, Speed, Accel, Rate=100):
+    Pos, Duration = TrapezoidFunc(Start, End, Speed, Accel)
+    return Sample(Pos, Duration, End, Rate)
+
+#===========================================================================================
+# Like Trapezoid, but acceleration ramps up and down at Jerk, for less of a jolt at
+# the start and end of the accelerations.  The trapezoid's speed profile averaged over
+# Accel/Jerk seconds is the jerk limited (7 segment) profile, so that's how it's done.
+#===========================================================================================
+def SCurve(Start, End, Speed, Accel, Jerk, Rate=100):
+    Pos, Duration = TrapezoidFunc(Start, End, Speed, Accel)
+    JerkTime = Accel/Jerk
+    Steps = 16
+    def Smoothed(t):
+        # Averaging position over the window is the same as averaging the speed.
+        return sum(Pos(t - JerkTime*(k+0.5)/Steps) for k in range(0, Steps))/Steps
+    return Sample(Smoothed, Duration + JerkTime, End, Rate)
+
+#===========================================================================================
+# Smooth curve thru a list of (time, position) waypoints, starting and ending at rest.
+# Cubic Hermite segments, with the speed at each waypoint taken from its neighbours
+# (Catmull-Rom), so it goes thru every waypoint.
+#===========================================================================================
+def Spline(Waypoints, Rate=100):
+    Times = [w[0] for w in Waypoints]
+    Points = [w[1] for w in Waypoints]
+    n = len(Waypoints)
+    if n < 2 or any(Times[k+1] <= Times[k] for k in range(0, n-1)):
+        raise ValueError("Need at least two waypoints, in increasing time")
+    Slopes = [0]*n
+    for k in range(1, n-1):
+        Slopes[k] = (Points[k+1]-Points[k-1])/(Times[k+1]-Times[k-1])
+
+    def Pos(t):
+        t += Times[0]
+        k = 0
+        while k < n-2 and t > Times[k+1]: k += 1
+        h = Times[k+1]-Times[k]
+        s = min(1, max(0, (t-Times[k])/h))
+        h00 = 2*s**3 - 3*s**2 + 1
+        h10 = s**3 - 2*s**2 + s
+        h01 = -2*s**3 + 3*s**2
+        h11 = s**3 - s**2
+        return (h00*Points[k] + h10*h*Slopes[k] + h01*Points[k+1] + h11*h*Slopes[k+1])
+    return Sample(Pos, Times[-1]-Times[0], Points[-1], Rate)
+
+# Stay at Pos for Seconds.
+def Dwell(Pos, Seconds, Rate=100):
+    return Sample(lambda t: Pos, Seconds, Pos, Rate)
+
+#===========================================================================================
+# Result of streaming a trajectory.
+#   Times, Setpoints, Actual:  for each position read, time it was sent, setpoint at that
+#                              time, and position read back (None if dropped).
+#   MaxError, RmsError:        Tracking error, Go_Absolute_Pos units.
+#   Late:                      Times it fell more than a period behind (and skipped setpoints)
+#   Schedule:                  Timing stats, from PeriodicSchedule.Stats()
+#===========================================================================================
+class StreamResult:
+    def __init__(self):
+        self.Times = []
+        self.Setpoints = []
+        self.Actual = []
+        self.Late = 0
+        self.Schedule = None
+
+    def Errors(self):
+        return [a-s for s, a in zip(self.Setpoints, self.Actual) if a is not None]
+
+    @property
+    def MaxError(self):
+        Errors = self.Errors()
+        return max(abs(e) for e in Errors) if Errors else None
+
+    @property
+    def RmsError(self):
+        Errors = self.Errors()
+        return math.sqrt(sum(e*e for e in Errors)/len(Errors)) if Errors else None
+
+#===========================================================================================
+# Send the setpoints of a trajectory to the drive, each at its scheduled time, with a
+# position read after every ReadEvery'th setpoint to see how well the motor follows.
+# Keep the reads below about 50 a second or the controller drops them.
+#===========================================================================================
+def Stream(Traj, ReadEvery=4, id=-1):
+    Result = StreamResult()
+    Reads = [] # (Time, setpoint, pending read)
+    Period = 1/Traj.Rate
+    Tick = dmm.PeriodicSchedule(Period)
+    Last = len(Traj.Positions)-1
+    n = -1
+    Sent = 0
+    while n < Last:
+        if Tick.Wait() > Period: Result.Late += 1
+        n = min(Tick.Count-1, Last) # Skips setpoints that are already past due.
+        dmm.GoAbsolutePos(Traj.Positions[n], id)
+        if ReadEvery and Sent % ReadEvery == 0:
+            Reads.append((n*Period, Traj.Positions[n], dmm.SendCommand(dmm.GENERAL_READ, 0x1b, id)))
+        Sent += 1
+    Result.Schedule = Tick.Stats()
+
+    for t, Setpoint, Pending in Reads:
+        Actual = Pending.Result()
+        Result.Times.append(t)
+        Result.Setpoints.append(Setpoint)
+        Result.Actual.append(None if Actual is None else Actual/4) # Reads back 65536 per turn
+    return Result
@@ -1,28 +1,44 @@
 # Scope screen for ServoTune program.
-import time
+import time, math, array, bisect, itertools
 import dmmlib as dmm
+import dmmshm
 
 # Data storage
 time_window = 2  # seconds
-samples_per_second = 155  # Samples per second target rate.
+samples_per_second = 50  # Sample rate to start with.
 # Due to python slowness, its always less than target.
 # But a greater limit to how fast we can sample is the DMM servo controller,
 # which has a tendency to drop queries if they are sent quickly.
 # the serial communications speed should be able to handle 500 position queries
 # per second, but sending queries at a rate above about 50 per second causes some
-# queries to get dropped.  Very frustrating.
+# queries to get dropped.  Very frustrating.  So the sample rate is adjusted
+# on the fly to the fastest rate that doesn't get queries dropped.
+rate_control = dmm.QueryRateControl(samples_per_second)
 #
-# Also, if scope has been running for a while, it starts to get slow.  this
-# probably due to the python heap getting more complex over time, slowing
-# down python execution.  If you use the scope mode a lot, its a good idea
-# to restart ths program frequently.  Python may not have been the best choice
-# for implementing something like the scope mode.
-
-value_data = []
-time_data = []
-requested_times = []
+# Samples are taken by a dmm.Sampler in a thread of its own, so the sample times
+# don't depend on what the GUI is busy with.  The graph is redrawn frame_rate times
+# a second with whatever samples came in since.  Sample times are time.perf_counter().
+frame_rate = 30
+schedule = dmm.PeriodicSchedule(1/frame_rate)
+#
+# Scope used to get slow after running a while.  That was from drawing each new
+# line segment as its own canvas item, so the canvas kept getting more items to
+# deal with.  Now it's just two lines, this sweep and what's left of the last one,
+# which get their coordinates replaced on each update.
+
+# Samples kept in fixed size ring buffers, enough for two sweeps at the fastest rate
+# QueryRateControl goes to.
+buffer_size = time_window*2*rate_control.MaxRate
+value_data = dmm.RingBuffer(buffer_size)
+time_data = dmm.RingBuffer(buffer_size)
+sampler = None
 x_origin = 0
 
+# Samples are also published to shared memory, so other programs can log or analyse
+# them while the scope runs, without sending more queries ("python3 dmmshm.py")
+publish_telemetry = True
+telemetry = None
+
 aquiring_active = False
 print("scope init")
 
@@ -35,136 +51,153 @@ def dummy_data():
     random_avg = random_avg*0.95 + r
     return random_avg + r
 
-ReqCount = 0
 def update_data(start=False):
-    # Called periodically to add data to the graph.
-    global aquiring_active, requested_times
+    # Called frame_rate times a second to add new samples to the graph.
+    global aquiring_active
     if not aquiring_active:
         unwrapped_plot()
         return
 
-    root.after(int(1000 / samples_per_second), update_data)  # Schedule next update
-    dmm.RecvData(0)  # Read serial to get previous position
-
-    numgot = len(dmm.DecodedQueue)
-    numnewpos = 0
-    if numgot:
-        for n in range (0, numgot):
-            rx_item = dmm.DecodedQueue[n]
-            if rx_item[1] == 0x1b:
-                value_data.append(rx_item[2])
-                t = requested_times[n]
-                if t == 0: print("Zero time!!!") # somehow got out of sync or something!
-                time_data.append(t)
-                numnewpos += 1
-            elif rx_item[1] == 0x10:
-                # Main gain reply for syncronization.  Find corresponding dummy timestamp.
-                #print("       got mg")
-                for k in range (n, len(requested_times)):
-                    if requested_times[k] == 0:
-                        if k != n:
-                            print("DMM ignored Pos requests: ",k-n)
-                            requested_times = requested_times[k-n:] # Discard excess timestamps
-                        break;
-
-
-        dmm.DecodedQueue = []
-
-        requested_times = requested_times[numgot:] # don't clear -- may have more replies pending
-        if numnewpos: update_plot(numnewpos)
-
-    dmm.ReqPosRead() # Request next position read
-    now = time.time() # Remember when request was sent (this has less jitter than received tiem)
-    requested_times.append(now)
-
-    global ReqCount
-    ReqCount += 1
-    if ReqCount & 7 == 0:
-        # Send occasional unrelated command to detect when position requests were ignored
-        # in order to get back in sync with the timestamps I saved when sending the request
-        dmm.SendCommand(0x18)
-        requested_times.append(0)
-        #print("req mg")
+    schedule.Mark()
+    root.after(schedule.Delay(), update_data)  # Schedule next frame
+
+    # Sampler works out which position requests the DMM ignored, and timestamps
+    # each sample with when it was requested (less jitter than received time).
+    samples = sampler.Take(0x1b)
+    for t, value in samples: add_sample(t, value)
+    if samples: update_plot()
+
+
+sweep_line = None     # Canvas line for the current sweep
+old_sweep_line = None # and for the part of the previous sweep not written over yet
+erase_gap = 0.05      # Seconds of old sweep blanked ahead of the write point
+
+#----------------------------------------------------------------------------
+# Min and max of the samples in each pixel column of a sweep, updated as samples
+# come in.  Drawing goes down and up each column, so peaks stay visible however
+# many samples land in one column, and the number of points drawn depends on the
+# canvas width, not on how many samples there are.
+#----------------------------------------------------------------------------
+class SweepColumns:
+    def __init__(self, width, t_origin):
+        self.width = max(1, width)
+        self.t_origin = t_origin
+        self.x_scale = self.width / time_window
+        self.min = array.array("d", [math.inf])*self.width
+        self.max = array.array("d", [-math.inf])*self.width
+        self.first = self.width # Range of columns that have samples
+        self.last = -1
+
+    def add(self, t, value):
+        c = int((t-self.t_origin)*self.x_scale)
+        if c < 0 or c >= self.width: return
+        if value < self.min[c]: self.min[c] = value
+        if value > self.max[c]: self.max[c] = value
+        if c < self.first: self.first = c
+        if c > self.last: self.last = c
+
+    def coords(self, start_column=0):
+        height = canvas.winfo_height()
+        y_scale = height / 0x10000
+        coords = []
+        for c in range(max(start_column, self.first), self.last+1):
+            low = self.min[c]
+            if low == math.inf: continue # No samples in this column
+            high = self.max[c]
+            coords.append(c)
+            coords.append(height/2-(low-graph_center_val)*y_scale)
+            if high != low:
+                coords.append(c)
+                coords.append(height/2-(high-graph_center_val)*y_scale)
+        return coords
+
+columns = None     # SweepColumns of the current sweep
+old_columns = None # and the one before
+
+def create_lines():
+    global sweep_line, old_sweep_line
+    canvas.delete("graph")
+    sweep_line = canvas.create_line(0,0,0,0, fill="white", tags="graph", width=2)
+    old_sweep_line = canvas.create_line(0,0,0,0, fill="white", tags="graph", width=2)
 
+def set_line(line, coords):
+    if len(coords) >= 4:
+        canvas.coords(line, coords)
+        canvas.itemconfigure(line, state="normal")
+    else:
+        canvas.itemconfigure(line, state="hidden")
 
 def unwrapped_plot():
     # Updates the graph so that latest point is on the right side of the graph.
-    canvas.delete("graph")
+    if len(time_data) < 2: return
+    t_origin = time_data[-1]-time_window
+    start = bisect.bisect_left(time_data, t_origin)
+    window = SweepColumns(canvas.winfo_width(), t_origin)
+    times = itertools.chain(*time_data.Views(start))
+    values = itertools.chain(*value_data.Views(start))
+    for t, value in zip(times, values): window.add(t, value)
+    set_line(sweep_line, window.coords())
+    canvas.itemconfigure(old_sweep_line, state="hidden")
 
-    height = canvas.winfo_height()
-    x_scale = canvas.winfo_width() / time_window
-    y_scale = height / 0x10000
-    x_origin = time_data[-1]-time_window
 
-    xo = -1
-    for i in range (1, len(value_data)):
-        x = x_scale * (time_data[i]-x_origin)
-        y =  height/2-(value_data[i]-graph_center_val)*y_scale
-        if xo >= 0:
-            canvas.create_line(xo,yo,x,y,fill="white", tags="graph", width=2)
-        xo = x; yo = y
-
-
-last_wrap_len = 0
 graph_center_val = -1
-def update_plot(numgot):
-    global x_origin, time_data, value_data, last_wrap_len, graph_center_val
-    height = canvas.winfo_height()
-    x_scale = canvas.winfo_width() / time_window
-    y_scale = height / 0x10000
-
-    if len(value_data) < numgot+2: return
-
-    if graph_center_val == -1: graph_center_val = value_data[0]
-
-    if time_data[-1] > x_origin+time_window:
-        x_origin += time_window
-        if last_wrap_len:
-            # Trim aquired data to just what is visible.
-            print("Trim ",last_wrap_len,"points from data", len(time_data), len(value_data), len(requested_times))
-            time_data = time_data[last_wrap_len:]
-            value_data = value_data[last_wrap_len:]
-        last_wrap_len = len(value_data)
-
-        #print("pts to check", len(value_data))
-        min_p = 1000000000; max_p = -1000000000
-        for p in value_data:
-            min_p = min(min_p,p)
-            max_p = max(max_p,p)
-
-        graph_center_val = int((min_p+max_p)/2)
-
-    xo = -1
-    for n in range(-2-numgot, -1):
-        # Calculate where to put new line segment
-        x  = x_scale * (time_data[n]-x_origin)
-
-        #offset = value_data[-1] & 0xffff0000
-        y =  height/2-(value_data[n]-graph_center_val)*y_scale
-
-        if xo >= 0:
-            canvas.create_line(xo,yo,x,y,fill="white", tags="graph", width=2)
-        else:
-            # Erase slightly ahead of write point so there is a gap
-            xe = x_scale * (time_data[-1]-x_origin)
-            canvas.create_rectangle(x+2, 0, xe+10, height, fill="gray", outline="")
-
-        xo = x; yo = y
+sweep_min = sweep_max = None # Range of values in this sweep, for centering the next.
+def add_sample(t, value):
+    global x_origin, graph_center_val, sweep_min, sweep_max, columns, old_columns
+    if graph_center_val == -1: graph_center_val = value
+
+    if t > x_origin+time_window:
+        # Start a new sweep, centered on the last one.
+        while t > x_origin+time_window: x_origin += time_window
+        if sweep_min is not None: graph_center_val = int((sweep_min+sweep_max)/2)
+        sweep_min = sweep_max = None
+        old_columns = columns
+        columns = SweepColumns(canvas.winfo_width(), x_origin)
+
+    time_data.Append(t)
+    value_data.Append(value)
+    columns.add(t, value)
+    if sweep_min is None:
+        sweep_min = sweep_max = value
+    elif value < sweep_min: sweep_min = value
+    elif value > sweep_max: sweep_max = value
+
+def update_plot():
+    # This sweep, from the left edge to the write point
+    set_line(sweep_line, columns.coords())
+
+    # Previous sweep, from a bit ahead of the write point to the right edge
+    if old_columns:
+        gap = int((columns.last + 1 + erase_gap*columns.x_scale) * old_columns.width/columns.width)
+        set_line(old_sweep_line, old_columns.coords(gap))
 
 
 def start_aquring():
-    global value_data, time_data, aquiring_active, x_origin, requested_times
+    global aquiring_active, x_origin, sampler, rate_control, schedule, graph_center_val, sweep_min
+    global columns, old_columns, telemetry
     dmm.ShowReplies = False
     dmm.RecvData()
-    dmm.DecodedQueue = []
-    dmm.SaveDecoded = True
 
-    value_data = []
-    time_data = []
-    requested_times = []
-    x_origin = time.time()
-
-    canvas.delete("graph")
+    value_data.Clear()
+    time_data.Clear()
+    graph_center_val = -1
+    sweep_min = None
+    x_origin = time.perf_counter()
+    rate_control = dmm.QueryRateControl(samples_per_second)
+    if sampler: sampler.Close()
+    if publish_telemetry and not telemetry:
+        try:
+            telemetry = dmmshm.TelemetryWriter()
+        except OSError as e:
+            print("Not publishing telemetry:", e)
+    sampler = dmm.Sampler({0x1b:1}, Rate=samples_per_second, RateControl=rate_control,
+                          Publish=telemetry.Publish if telemetry else None)
+    sampler.Start()
+    schedule = dmm.PeriodicSchedule(1/frame_rate)
+
+    create_lines()
+    columns = SweepColumns(canvas.winfo_width(), x_origin)
+    old_columns = None
     aquiring_active = True
     update_data(True)
     
@@ -172,6 +205,10 @@ def start_aquring():
 
 def stop():
     global aquiring_active
+    if not aquiring_active: return
     aquiring_active = False
-    dmm.SaveDecoded = False
-    print("scope stop")
+    sampler.Stop()
+    print("scope stop, %.0f samples/s, %d of %d requests dropped"%(
+            rate_control.Rate, rate_control.Dropped, rate_control.Sent))
+    print("scope sample timing:", sampler.Schedule.Summary())
+    print("scope frame timing:", schedule.Summary())